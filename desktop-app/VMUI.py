@@ -19,12 +19,14 @@
 # You should have received a copy of the GNU General Public License
 # along with FAIRSHELL.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import gi
 import enum
 import syslog
 import Utils as util
 gi.require_version("Gtk", "3.0")
 from gi.repository import GObject
+from gi.repository import GLib
 from gi.repository import Gtk
 gi.require_version('Gdk', '3.0')
 from gi.repository import Gdk
@@ -33,12 +35,45 @@ from gi.repository import SpiceClientGLib
 gi.require_version('SpiceClientGtk', '3.0')
 from gi.repository import SpiceClientGtk
 
+# style of the VM actions' widgets: no rounded corners, shadows nor transitions which are costly
+# when rendering is done in software
+_actions_css=b"""
+.vm-actions, .vm-actions * {
+    border-radius: 0;
+    box-shadow: none;
+    transition: none;
+}
+"""
+_css_provider=None
+
+def _install_css_provider():
+    """Install the CSS provider for the VM actions' widgets, once for the default screen"""
+    global _css_provider
+    if _css_provider is None:
+        _css_provider=Gtk.CssProvider()
+        _css_provider.load_from_data(_actions_css)
+        Gtk.StyleContext.add_provider_for_screen(Gdk.Screen.get_default(), _css_provider,
+                                                 Gtk.STYLE_PROVIDER_PRIORITY_APPLICATION)
+
+# keys combinations which can be sent to the VM, as (label, key codes)
+_key_combos=(
+    ("Ctrl+Alt+Del", (Gdk.KEY_Control_L, Gdk.KEY_Alt_L, Gdk.KEY_Delete)),
+    ("Ctrl+Alt+BackSpace", (Gdk.KEY_Control_L, Gdk.KEY_Alt_L, Gdk.KEY_BackSpace)),
+    ("Ctrl+Alt+F1", (Gdk.KEY_Control_L, Gdk.KEY_Alt_L, Gdk.KEY_F1)),
+    ("Ctrl+Alt+F2", (Gdk.KEY_Control_L, Gdk.KEY_Alt_L, Gdk.KEY_F2)),
+    ("Ctrl+Alt+F3", (Gdk.KEY_Control_L, Gdk.KEY_Alt_L, Gdk.KEY_F3)),
+    ("Ctrl+Alt+F4", (Gdk.KEY_Control_L, Gdk.KEY_Alt_L, Gdk.KEY_F4)),
+    ("Ctrl+Alt+F5", (Gdk.KEY_Control_L, Gdk.KEY_Alt_L, Gdk.KEY_F5))
+)
+
+@enum.unique
 class DeviceType(str, enum.Enum):
     """USB device types"""
     MASS_STORAGE = "mass-storage"
     SMARTCARD = "smartcard"
     OTHER = "other"
 
+@enum.unique
 class DeviceState(str, enum.Enum):
     """USB device states with regards to the VM"""
     DISCONNECTED = "DISCONNECTED"
@@ -51,24 +86,86 @@ _mapping={
     #"11": DeviceType.SMARTCARD # for future evolution
 }
 
-def _identify_device_type(vendor_product):
-    """Identifies an USB device and returns (DeviceType, human description)"""
-    human=None
-    (status, out, err)=util.exec_sync(["lsusb", "-v", "-d", vendor_product])
-    if status!=0:
-        raise Exception("Could not get infos. about USB device %s"%vendor_product)
-    for line in out.splitlines():
-        if line.startswith("Bus ") and vendor_product in line:
-            # get the product's user friendly description 
-            pos=line.rfind(vendor_product)+len(vendor_product)+1
-            human=line[pos:]
-        else:
-            line=line.strip()
-            if line.startswith("bInterfaceClass"):
-                parts=line.split()
-                if parts[1] in _mapping:
-                    return (_mapping[parts[1]], human)
-    return (DeviceType.OTHER, human)
+_sysfs_usb_dir="/sys/bus/usb/devices"
+_devtypes_cache={} # key="<vendor ID>:<product ID>", value=(DeviceType, human description)
+
+def _read_sysfs_attr(path):
+    """Read a sysfs attribute, returns None if it does not exist"""
+    try:
+        with open(path, "r") as file:
+            return file.read().strip()
+    except OSError:
+        return None
+
+def _describe_sysfs_device(devname):
+    """Get information about an USB device from its sysfs entry, returns
+    (vendor ID, product ID, DeviceType, human description), or None if @devname is not a device"""
+    if ":" in devname: # USB interface, not a device
+        return None
+    devpath="%s/%s"%(_sysfs_usb_dir, devname)
+    vendor_id=_read_sysfs_attr("%s/idVendor"%devpath)
+    product_id=_read_sysfs_attr("%s/idProduct"%devpath)
+    if vendor_id is None or product_id is None:
+        return None
+
+    # get the product's user friendly description
+    parts=[]
+    for attr in ("manufacturer", "product"):
+        value=_read_sysfs_attr("%s/%s"%(devpath, attr))
+        if value:
+            parts+=[value]
+    if parts:
+        human=" ".join(parts)
+    else:
+        human="Bus %s Device %s: ID %s:%s"%(_read_sysfs_attr("%s/busnum"%devpath),
+                                             _read_sysfs_attr("%s/devnum"%devpath), vendor_id, product_id)
+
+    # interfaces are like <devname>:<config>.<interface>
+    dtype=DeviceType.OTHER
+    for intfname in os.listdir(devpath):
+        if not intfname.startswith("%s:"%devname):
+            continue
+        iclass=_read_sysfs_attr("%s/%s/bInterfaceClass"%(devpath, intfname))
+        if iclass and str(int(iclass, 16)) in _mapping:
+            dtype=_mapping[str(int(iclass, 16))]
+            break
+    return (vendor_id, product_id, dtype, human)
+
+def _snapshot_usb_sysfs():
+    """Identifies all the USB devices currently plugged in a single pass, and returns a dictionary
+    where keys are (vendor ID, product ID) and values are (DeviceType, human description)"""
+    snapshot={}
+    for devname in os.listdir(_sysfs_usb_dir):
+        infos=_describe_sysfs_device(devname)
+        if infos:
+            (vendor_id, product_id, dtype, human)=infos
+            if (vendor_id, product_id) not in snapshot:
+                snapshot[(vendor_id, product_id)]=(dtype, human)
+                _devtypes_cache["%s:%s"%(vendor_id, product_id)]=(dtype, human)
+    return snapshot
+
+def _identify_device_type(vendor_product, bus=None, address=None):
+    """Identifies an USB device and returns (DeviceType, human description).
+    If @bus and @address are specified, then the device's sysfs entry is directly accessed
+    instead of looking for it among all the USB devices"""
+    if vendor_product in _devtypes_cache:
+        return _devtypes_cache[vendor_product]
+
+    (vendor_id, product_id)=vendor_product.split(":")
+    if bus is not None and address is not None:
+        # USB devices are character devices with major 189 and minor (bus-1)*128+(address-1)
+        devname=os.path.basename(os.path.realpath("/sys/dev/char/189:%d"%((bus-1)*128+address-1)))
+        devnames=[devname]
+    else:
+        devnames=os.listdir(_sysfs_usb_dir)
+    for devname in devnames:
+        infos=_describe_sysfs_device(devname)
+        if infos and infos[0]==vendor_id and infos[1]==product_id:
+            _devtypes_cache[vendor_product]=infos[2:]
+            return infos[2:]
+    if bus is not None and address is not None:
+        return _identify_device_type(vendor_product)
+    raise Exception("Could not get infos. about USB device %s"%vendor_product)
 
 class UsbDevice(GObject.GObject):
     """Represents an USB device which can be connected to the VM"""
@@ -100,8 +197,9 @@ class UsbDevice(GObject.GObject):
 
     @state.setter
     def state(self, state):
-        state=DeviceState(state)
-        if self._state!=state:
+        if not isinstance(state, DeviceState):
+            state=DeviceState(state)
+        if self._state is not state:
             self._state=state
             self.emit("state-changed")
 
@@ -115,22 +213,29 @@ class VMActions(Gtk.Grid):
 
     def __init__(self, vmui):
         Gtk.Grid.__init__(self)
+        self.get_style_context().add_class("vm-actions")
         self._vmui=vmui
         self._session=vmui.spice_session
         usb_dm=SpiceClientGLib.UsbDeviceManager.get(self._session)
         usb_dm.connect("device-added", self._device_added_cb)
         usb_dm.connect("device-removed", self._device_removed_cb)
         usb_dm.connect("device-error", self._device_error_cb)
+        self._usb_dm=usb_dm
 
         self._usb_redir_classes=["all"]
         self._devices={} # key = a SpiceUsbDevice, value=UsbDevice, if device is presented to the user
         self._devices_analyzed=False # devices are analysed the 1st time they are required, not before as the
                                      # session may not yet be fully "connected" and redirection may not be possible
+        self._root_dev_ids=None # (vendor ID, product ID) of the USB devices holding the live Linux, computed once
         self._devices_popover=None
         self._devices_grid=None
         self._devices_grid_vindex=0
+        self._devices_rows=0 # number of devices listed in self._devices_grid
+        self._pending_adds=[] # SpiceUsbDevice added since the last _flush_pending_adds()
+        self._pending_analysis=set() # SpiceUsbDevice stashed before the devices have been analysed
         self._keyboard_popover=None
         self._reveal=Gtk.Revealer()
+        self._revealed=False # mirrors self._reveal's "reveal-child" property
         self.attach(self._reveal, 0, 0, 1, 1)
         self._reveal.show()
         self.reveal()
@@ -150,23 +255,12 @@ class VMActions(Gtk.Grid):
         bb.add(button)
         self._fullscreen_button=button
         self._fullscreen_button_sigid=button.connect("toggled", self._button_fullscreen_cb)
-        self._vmui.connect("size-allocate", self._size_allocate_cb, button)
+        self._vmui_map_sigid=self._vmui.connect("map", self._vmui_map_cb, button)
 
-        # USB devices to connect
-        button=Gtk.Button(label="USB devices")
-        button.set_tooltip_text("Transfer USB devices")
-        bb.add(button)
-        button.connect("clicked", self._button_devices_cb)
-        self._dev_button=button
-        self._dev_button.connect("show", self._dev_button_show_cb)
-
-        # send keyboard keys combinations
-        button=Gtk.Button(label="Keyboard")
-        button.set_tooltip_text("Send keyboard events")
-        bb.add(button)
-        button.connect("clicked", self._button_keyboard_cb)
-        self._keyb_button=button
-        self._keyb_button.connect("show", self._keyb_button_show_cb)
+        # USB devices and keyboard buttons are only created when needed,
+        # see _build_dev_button() and _build_keyb_button()
+        self._dev_button=None
+        self._keyb_button=None
 
         # close button
         image=Gtk.Image.new_from_icon_name("window-close", Gtk.IconSize.MENU)
@@ -177,28 +271,71 @@ class VMActions(Gtk.Grid):
         button.connect("clicked", self._button_close_cb)
 
         bb.show_all()
+        self._bb=bb
+        self.connect("realize", self._realize_cb)
 
-    def _size_allocate_cb(self, widget, rect, toggle_button):
-        # ensure that the toggle button's position is always on par with the actual window state
+    def _realize_cb(self, widget):
+        # create the buttons which are enabled by default and have not yet been created
+        self._dev_button_show_cb(None)
+        self._keyb_button_show_cb(None)
+
+    def _build_dev_button(self):
+        """Create the USB devices button, if not yet done"""
+        if self._dev_button is None:
+            button=Gtk.Button(label="USB devices")
+            button.set_tooltip_text("Transfer USB devices")
+            self._bb.add(button)
+            self._bb.reorder_child(button, 1) # right after the fullscreen button
+            button.connect("clicked", self._button_devices_cb)
+            self._dev_button=button
+            self._dev_button.connect("show", self._dev_button_show_cb)
+
+    def _build_keyb_button(self):
+        """Create the button to send keyboard keys combinations, if not yet done"""
+        if self._keyb_button is None:
+            button=Gtk.Button(label="Keyboard")
+            button.set_tooltip_text("Send keyboard events")
+            self._bb.add(button)
+            self._bb.reorder_child(button, 2 if self._dev_button else 1) # right before the close button
+            button.connect("clicked", self._button_keyboard_cb)
+            self._keyb_button=button
+            self._keyb_button.connect("show", self._keyb_button_show_cb)
+
+    def _vmui_map_cb(self, widget, toggle_button):
+        # track the toplevel window's state changes, once it is known
         topwin=widget.get_ancestor(Gtk.Window)
         if topwin:
+            widget.disconnect(self._vmui_map_sigid)
+            topwin.connect("window-state-event", self._window_state_cb, toggle_button)
             gdkwin=topwin.get_window()
             if gdkwin:
-                is_full=True if gdkwin.get_state() & Gdk.WindowState.FULLSCREEN else False
-                GObject.signal_handler_block(self._fullscreen_button, self._fullscreen_button_sigid)
-                toggle_button.set_active(is_full)
-                GObject.signal_handler_unblock(self._fullscreen_button, self._fullscreen_button_sigid)
+                self._set_fullscreen_button_state(toggle_button, gdkwin.get_state())
+
+    def _window_state_cb(self, topwin, event, toggle_button):
+        if event.changed_mask & Gdk.WindowState.FULLSCREEN:
+            self._set_fullscreen_button_state(toggle_button, event.new_window_state)
+        return False
+
+    def _set_fullscreen_button_state(self, toggle_button, state):
+        # ensure that the toggle button's position is always on par with the actual window state
+        is_full=True if state & Gdk.WindowState.FULLSCREEN else False
+        GObject.signal_handler_block(self._fullscreen_button, self._fullscreen_button_sigid)
+        toggle_button.set_active(is_full)
+        GObject.signal_handler_unblock(self._fullscreen_button, self._fullscreen_button_sigid)
 
     def _dev_button_show_cb(self, dummy):
         if len(self._usb_redir_classes)==0:
-            self._dev_button.hide()
+            if self._dev_button:
+                self._dev_button.hide()
         else:
+            self._build_dev_button()
             self._dev_button.show()
 
     def _keyb_button_show_cb(self, dummy):
         if self._has_keyboard:
+            self._build_keyb_button()
             self._keyb_button.show()
-        else:
+        elif self._keyb_button:
             self._keyb_button.hide()
 
     @property
@@ -208,7 +345,8 @@ class VMActions(Gtk.Grid):
     @has_keyboard.setter
     def has_keyboard(self, value):
         self._has_keyboard=value
-        self._keyb_button_show_cb(None)
+        if self.get_realized() or self._keyb_button:
+            self._keyb_button_show_cb(None)
 
     @property
     def usb_redir_classes(self):
@@ -217,7 +355,8 @@ class VMActions(Gtk.Grid):
     @usb_redir_classes.setter
     def usb_redir_classes(self, classes):
         self._usb_redir_classes=classes
-        self._dev_button_show_cb(None)
+        if self.get_realized() or self._dev_button:
+            self._dev_button_show_cb(None)
 
     def _send_key_cb(self, button, codes):
         display=self._vmui.spice_display
@@ -228,6 +367,7 @@ class VMActions(Gtk.Grid):
     def _button_keyboard_cb(self, button):
         if self._keyboard_popover is None:
             popover=Gtk.Popover()
+            popover.get_style_context().add_class("vm-actions")
             popover.set_relative_to(self._keyb_button)
             
             grid=Gtk.Grid()
@@ -235,22 +375,11 @@ class VMActions(Gtk.Grid):
             grid.set_column_spacing(10)
             grid.set_property("row-spacing", 0)
 
-            keys={
-                "Ctrl+Alt+Del": [Gdk.KEY_Control_L, Gdk.KEY_Alt_L, Gdk.KEY_Delete],
-                "Ctrl+Alt+BackSpace": [Gdk.KEY_Control_L, Gdk.KEY_Alt_L, Gdk.KEY_BackSpace],
-                "Ctrl+Alt+F1": [Gdk.KEY_Control_L, Gdk.KEY_Alt_L, Gdk.KEY_F1],
-                "Ctrl+Alt+F2": [Gdk.KEY_Control_L, Gdk.KEY_Alt_L, Gdk.KEY_F2],
-                "Ctrl+Alt+F3": [Gdk.KEY_Control_L, Gdk.KEY_Alt_L, Gdk.KEY_F3],
-                "Ctrl+Alt+F4": [Gdk.KEY_Control_L, Gdk.KEY_Alt_L, Gdk.KEY_F4],
-                "Ctrl+Alt+F5": [Gdk.KEY_Control_L, Gdk.KEY_Alt_L, Gdk.KEY_F5]
-            }
-            top=0
-            for combo in keys:
+            for (top, (combo, codes)) in enumerate(_key_combos):
                 button=Gtk.Button(label=combo)
-                button.connect("clicked", self._send_key_cb, keys[combo])
+                button.connect("clicked", self._send_key_cb, codes)
                 button.set_property("relief", Gtk.ReliefStyle.NONE)
                 grid.attach(button, 0, top, 1, 1)
-                top+=1
 
             popover.add(grid)
             popover.show_all()
@@ -264,32 +393,70 @@ class VMActions(Gtk.Grid):
     def _device_added_cb(self, usb_dm, usb_dev):
         """Signalled by Spice's device manager: a device has been added"""
         syslog.syslog(syslog.LOG_INFO, "Device added: %s"%usb_dev)
-        if self._devices_analyzed:
+        # stash the device to be analysed later
+        self._devices[usb_dev]=None
+        if not self._devices_analyzed:
+            self._pending_analysis.add(usb_dev)
+        elif usb_dev not in self._pending_adds:
+            # several devices are usually added at once (e.g. for a USB hub): handle them all
+            # when idle, with a single UI update
+            if len(self._pending_adds)==0:
+                GLib.idle_add(self._flush_pending_adds, priority=GLib.PRIORITY_DEFAULT_IDLE)
+            self._pending_adds+=[usb_dev]
+
+    def _flush_pending_adds(self):
+        """Analyse the devices added since the last call and add them to the list of devices"""
+        pending=self._pending_adds
+        self._pending_adds=[]
+        added=False
+        for usb_dev in pending:
+            if usb_dev not in self._devices: # removed in the meantime
+                continue
             dev=self._analyze_usb_device(usb_dev)
             if dev is not None and self._devices_popover:
                 self._add_device_entry(dev)
-        else:
-            # stash the device to be analysed later
-            self._devices[usb_dev]=None
+                added=True
+        if added:
+            self._devices_grid.show_all()
+        return False # remove the idle source
 
     def _device_removed_cb(self, usb_dm, usb_dev):
         """Signalled by Spice's device manager: a device has been removed"""
         syslog.syslog(syslog.LOG_INFO, "Device removed: %s"%usb_dev)
-        dev=self._devices[usb_dev]
+        dev=self._devices.pop(usb_dev, None) # may already have been removed by _device_error_cb()
         if dev is not None and self._devices_popover:
             self._remove_device_entry(dev)
-        del self._devices[usb_dev]
+        self._pending_analysis.discard(usb_dev)
 
     def _device_error_cb(self, usb_dm, usb_dev, error):
         """Signalled by Spice's device manager: a device has issued an error"""
         syslog.syslog(syslog.LOG_ERR, "Device error: %s / %s"%(usb_dev, error))
-        del self._devices[usb_dev]
-
-    def _analyze_usb_device(self, usb_dev):
+        self._devices.pop(usb_dev, None)
+        self._pending_analysis.discard(usb_dev)
+
+    def _get_root_dev_ids(self):
+        """Get the set of (vendor ID, product ID) of the USB devices from which the live Linux runs,
+        or an empty set if the system is not a live Linux"""
+        if self._root_dev_ids is None:
+            ids=set()
+            root_dev=util.get_root_live_partition(exception_if_no_live=False)
+            if root_dev:
+                # walk up the block device's sysfs path until the USB device holding it
+                path=os.path.realpath("/sys/class/block/%s"%os.path.basename(os.path.realpath(root_dev)))
+                while path.startswith("/sys/devices/"):
+                    vendor_id=_read_sysfs_attr("%s/idVendor"%path)
+                    product_id=_read_sysfs_attr("%s/idProduct"%path)
+                    if vendor_id and product_id:
+                        ids.add((vendor_id, product_id))
+                        break
+                    path=os.path.dirname(path)
+            self._root_dev_ids=ids
+        return self._root_dev_ids
+
+    def _analyze_usb_device(self, usb_dev, snapshot=None):
         """Analyse a specific USB device, and determine if it can be "connected"
-        to the VM"""
-        root_dev=util.get_root_live_partition(exception_if_no_live=False)
-        usb_dm=SpiceClientGLib.UsbDeviceManager.get(self._session)
+        to the VM. @snapshot, if specified, is the result of _snapshot_usb_sysfs() and is used
+        to identify the device"""
         descr=usb_dev.get_description("%s|%s|%s|%d|%d")
         parts=descr.split("|")
         add_to_redirect=False
@@ -297,8 +464,12 @@ class VMActions(Gtk.Grid):
             vp=parts[-3] # like [1b2c:1a0f]
             vp=vp[1:-1]
             (vendor_id,product_id)=vp.split(":")
-            (dtype, human)=_identify_device_type("%s:%s"%(vendor_id,product_id))
-            if usb_dm.can_redirect_device(usb_dev):
+            if snapshot and (vendor_id, product_id) in snapshot:
+                (dtype, human)=snapshot[(vendor_id, product_id)]
+            else:
+                (dtype, human)=_identify_device_type("%s:%s"%(vendor_id,product_id),
+                                                     bus=int(parts[-2]), address=int(parts[-1]))
+            if self._usb_dm.can_redirect_device(usb_dev):
                 add_to_redirect=True
                 if "all" in self._usb_redir_classes:
                     pass
@@ -306,19 +477,9 @@ class VMActions(Gtk.Grid):
                     add_to_redirect=False
 
                 #  remove mass storage device if it's where the live Linux is
-                if add_to_redirect and dtype==DeviceType.MASS_STORAGE and root_dev:
-                    # check that this device is not the one where a live Linux resides
-                    (status, out, err)=util.exec_sync(["udevadm", "info", "-n", root_dev ,"-a"])
-                    if status==0:
-                        found=0
-                        for line in out.splitlines():
-                            if '=="%s"'%vendor_id in line and "{idVendor}" in line:
-                                found+=1
-                            elif '=="%s"'%product_id in line and "{idProduct}" in line:
-                                found+=1
-                            if found==2:
-                                add_to_redirect=False
-                                break
+                if add_to_redirect and dtype==DeviceType.MASS_STORAGE and \
+                   (vendor_id, product_id) in self._get_root_dev_ids():
+                    add_to_redirect=False
         except Exception:
             pass
 
@@ -331,9 +492,8 @@ class VMActions(Gtk.Grid):
 
     def _device_connect_result_cb(self, usb_dev, res, dev):
         """Called when the operation of connecting a device terminates""" 
-        usb_dm=SpiceClientGLib.UsbDeviceManager.get(self._session)
         try:
-            fres=usb_dm.connect_device_finish(res)
+            fres=self._usb_dm.connect_device_finish(res)
             dev.state=DeviceState.CONNECTED
             syslog.syslog(syslog.LOG_INFO, "Device connected: %s"%dev.descr)
         except Exception as e:
@@ -342,10 +502,9 @@ class VMActions(Gtk.Grid):
 
     def _device_disconnect_result_cb(self, usb_dev, res, dev):
         """Called when the operation of disconnecting a device terminates""" 
-        usb_dm=SpiceClientGLib.UsbDeviceManager.get(self._session)
         dev.state=DeviceState.DISCONNECTED
         try:
-            fres=usb_dm.disconnect_device_finish(res)
+            fres=self._usb_dm.disconnect_device_finish(res)
             syslog.syslog(syslog.LOG_INFO, "Device no more connected: %s"%dev.descr)
         except Exception as e:
             syslog.syslog(syslog.LOG_ERR, "Device not disconnected: %s / %s"%(dev.descr, str(e)))
@@ -354,13 +513,16 @@ class VMActions(Gtk.Grid):
         """Called to show the connectable and already connected devices"""
         # force devices anlysis if not yet done
         if not self._devices_analyzed:
-            for usb_dev in list(self._devices.keys()):
-                self._analyze_usb_device(usb_dev)
+            snapshot=_snapshot_usb_sysfs()
+            for usb_dev in self._pending_analysis:
+                self._analyze_usb_device(usb_dev, snapshot)
+            self._pending_analysis.clear()
             self._devices_analyzed=True
 
         # build widgets if necessary
         if not self._devices_popover:
             self._devices_popover=Gtk.Popover()
+            self._devices_popover.get_style_context().add_class("vm-actions")
             self._devices_popover.set_relative_to(self._dev_button)
             
             grid=Gtk.Grid()
@@ -373,7 +535,6 @@ class VMActions(Gtk.Grid):
             self._devices_none_label=Gtk.Label(label="N/A")
             self._devices_grid.attach(self._devices_none_label, 1, self._devices_grid_vindex, 2, 1)
             self._devices_none_label.show()
-            self._devices_none_label.dev=None # dummy but used in _remove_device_entry()
             self._devices_none_label.connect("show", self._devices_none_label_keyb_button_show_cb)
             self._devices_grid_vindex+=1
 
@@ -389,9 +550,7 @@ class VMActions(Gtk.Grid):
             self._devices_popover.show()
 
     def _devices_none_label_keyb_button_show_cb(self, widget):
-        children=self._devices_grid.get_children()
-        nbchildren=len(children)
-        if nbchildren!=1:
+        if self._devices_rows>0:
             self._devices_none_label.hide()
 
     def _add_device_entry(self, dev):
@@ -411,30 +570,29 @@ class VMActions(Gtk.Grid):
         label.set_property("xalign", 0)
         self._devices_grid.attach(label, 1, self._devices_grid_vindex, 1, 1)
         self._devices_grid_vindex+=1
+        self._devices_rows+=1
+        dev.cbox=cbox
+        dev.label=label
 
-        cbox.show()
-        label.show()
         self._devices_none_label.hide()
 
     def _remove_device_entry(self, dev):
         # Removing widgets associated to @dev
-        children=self._devices_grid.get_children()
-        nbchildren=len(children)-2
-        for child in children:
-            if child.dev==dev: # GtkLabel and GtkCheckButton both point to the same @dev
-                self._devices_grid.remove(child)
-        if nbchildren==1: # only the self._devices_none_label remains
+        self._devices_grid.remove(dev.cbox)
+        self._devices_grid.remove(dev.label)
+        dev.cbox=None
+        dev.label=None
+        self._devices_rows-=1
+        if self._devices_rows==0: # only the self._devices_none_label remains
             self._devices_none_label.show()
 
     def _device_toggled_cb(self, checkbox, dev):
         if checkbox.get_active():
             dev.state=DeviceState.CONNECTING
-            usb_dm=SpiceClientGLib.UsbDeviceManager.get(self._session)
-            usb_dm.connect_device_async(dev.usb_dev, None, self._device_connect_result_cb, dev)
+            self._usb_dm.connect_device_async(dev.usb_dev, None, self._device_connect_result_cb, dev)
         else:
             dev.state=DeviceState.DISCONNECTING
-            usb_dm=SpiceClientGLib.UsbDeviceManager.get(self._session)
-            usb_dm.disconnect_device_async(dev.usb_dev, None, self._device_disconnect_result_cb, dev)
+            self._usb_dm.disconnect_device_async(dev.usb_dev, None, self._device_disconnect_result_cb, dev)
 
     def _dev_state_changed_cb(self, dev, cbox):
         assert dev==cbox.dev
@@ -457,10 +615,14 @@ class VMActions(Gtk.Grid):
         self.emit("close")
 
     def reveal(self):
-        self._reveal.set_reveal_child(True)
+        if not self._revealed:
+            self._reveal.set_reveal_child(True)
+            self._revealed=True
 
     def unreveal(self):
-        self._reveal.set_reveal_child(False)
+        if self._revealed:
+            self._reveal.set_reveal_child(False)
+            self._revealed=False
 
 class VMUI(Gtk.Overlay):
     """Actual viewer"""
@@ -471,6 +633,7 @@ class VMUI(Gtk.Overlay):
             raise Exception("Invalid UI config data %s"%config_data)
 
         Gtk.Overlay.__init__(self)
+        _install_css_provider()
 
         # widgets
         self._session=SpiceClientGLib.Session()
@@ -483,14 +646,13 @@ class VMUI(Gtk.Overlay):
         self.add_overlay(self._actions)
         self.set_overlay_pass_through(self._actions, True)
         self._actions.show()
+        self._actions.connect("size-allocate", self._actions_size_allocate_cb)
 
         # misc.
         self._input_channel=None
         self._display=None # will be a SpiceClientGtk.Display
-        display=Gdk.Display.get_default()
-        seat=display.get_default_seat()
-        self._pointer=seat.get_pointer()
-        self._gdkwin=None
+        self._display_w=0 # allocated width of self._display, updated on each allocation
+        self._actions_w=0 # allocated width of self._actions, updated on each allocation
 
     @property
     def actions(self):
@@ -508,21 +670,24 @@ class VMUI(Gtk.Overlay):
     def spice_display(self):
         return self._display
 
+    def _actions_size_allocate_cb(self, widget, allocation):
+        self._actions_w=allocation.width
+
+    def _display_size_allocate_cb(self, widget, allocation):
+        self._display_w=allocation.width
+
     def _mouse_move_cb(self, window, event):
-        if self._gdkwin is None:
-            self._gdkwin=window.get_window()
-        (dummy, x, y, mask)=self._gdkwin.get_device_position(self._pointer)
+        # called for each mouse motion: use the event's coordinates and the cached widths
+        # instead of querying the display server
         r=False
-        if y<10:
-            win_w=self._gdkwin.get_width()
-            mid=win_w/2
-            act_w=self._actions.get_allocated_width()
-            if x>=mid-act_w and x<=mid+act_w:
+        if event.y<10:
+            mid=self._display_w/2
+            act_w=self._actions_w
+            if event.x>=mid-act_w and event.x<=mid+act_w:
                 self._actions.reveal()
                 r=True
         if not r:
             self._actions.unreveal()
-        self._display.set_property("keypress-delay", 0)
         return False
 
     def session_connect(self):
@@ -551,6 +716,7 @@ class VMUI(Gtk.Overlay):
             self._display.show()
 
             self._display.add_events(Gdk.EventMask.POINTER_MOTION_MASK)
+            self._display.connect("size-allocate", self._display_size_allocate_cb)
             self._display.connect("motion-notify-event", self._mouse_move_cb)
         elif ctype==3: # input channel
             self._input_channel=channel
@@ -558,6 +724,7 @@ class VMUI(Gtk.Overlay):
 
 def get_sane_default_vmui_size():
     """Compute a default reasonable size for the VM'UI window"""
+    (min_w, min_h)=(1080, 824)
     display=Gdk.Display.get_default()
     w=20000
     h=20000
@@ -566,6 +733,8 @@ def get_sane_default_vmui_size():
         rect=mon.get_workarea()
         w=min(w, rect.width)
         h=min(h, rect.height)
-    w=max(w-200, 1080)
-    h=max(h-200, 824)
+        if w-200<=min_w and h-200<=min_h:
+            break # the minimum size will be used anyway
+    w=max(w-200, min_w)
+    h=max(h-200, min_h)
     return (w,h)
\ No newline at end of file
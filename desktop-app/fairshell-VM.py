@@ -21,7 +21,6 @@
 
 import sys
 import os
-import json
 import syslog
 import dbus
 import dbus.service
@@ -37,6 +36,7 @@ from gi.repository import GdkPixbuf
 from gi.repository import GLib
 from gi.repository import Gio
 import VMUI
+import Utils as util
 
 class SingleApplication(dbus.service.Object):
     """Singleton DBus client for the specified VM"""
@@ -90,11 +90,21 @@ class VMRunner(SingleApplication):
 
         # UI part
         self._builder=Gtk.Builder()
-        self._builder.add_from_file("%s/fairshell-VM.ui"%os.path.dirname(__file__))
+        resource_file="%s/fairshell-VM.gresource"%os.path.dirname(__file__)
+        if os.path.exists(resource_file):
+            # pre-compiled UI definition (installed version)
+            Gio.resources_register(Gio.Resource.load(resource_file))
+            self._builder.add_from_resource("/org/fairshell/virt-system/fairshell-VM.ui")
+        else:
+            self._builder.add_from_file("%s/fairshell-VM.ui"%os.path.dirname(__file__))
         self._main_window=self._builder.get_object("main")
         self._main_window.set_title(self._app_name)
         self._main_nb=self._builder.get_object("main-nb")
         self._spinner=self._builder.get_object("spinner")
+        self._spinner_message=self._builder.get_object("spinnermessage")
+        self._error_message=self._builder.get_object("errormessage")
+        self._error_exp=self._builder.get_object("errorexp")
+        self._error_details=self._builder.get_object("errordetails")
 
         self._cancel_button=self._builder.get_object("cancel")
         self._close_button=self._builder.get_object("close")
@@ -109,7 +119,7 @@ class VMRunner(SingleApplication):
         self._connect_dbus_proxy()
 
         # Get VM's config infos
-        self._vm_infos=json.loads(self._proxy.get_configuration(self._conf_id))
+        self._vm_infos=self._proxy.get_configuration(self._conf_id)
         img=self._builder.get_object("vm-icon")
         if app_icon:
             if not os.path.isabs(app_icon):
@@ -121,11 +131,9 @@ class VMRunner(SingleApplication):
         label=self._builder.get_object("vm-descr")
         label.set_markup("<b><span size='x-large'>%s</span></b>"%self._vm_infos["descr"])
 
-    def _connect_dbus_proxy(self):
+    def _connect_dbus_proxy(self, renew=False):
         try:
-            bus=dbus.SystemBus()
-            obj=bus.get_object("org.fairshell.VMManager", "/remote/virtualmachines")
-            proxy=dbus.Interface(obj, dbus_interface='org.fairshell.VMManager')
+            proxy=util.get_vmmanager_proxy(renew)
             proxy.connect_to_signal("started", self._vm_started, dbus_interface="org.fairshell.VMManager")
             proxy.connect_to_signal("start_error", self._vm_start_error, dbus_interface="org.fairshell.VMManager")
             proxy.connect_to_signal("stopped", self._vm_stopped, dbus_interface="org.fairshell.VMManager")
@@ -143,8 +151,7 @@ class VMRunner(SingleApplication):
         self._cancel_button.show()
         self._cancel_button.set_sensitive(can_cancel)
         self._close_button.hide()
-        label=self._builder.get_object("spinnermessage")
-        label.set_text(message)
+        self._spinner_message.set_text(message)
         self._spinner.start()
 
     def _show_message(self, message):
@@ -152,22 +159,18 @@ class VMRunner(SingleApplication):
         self._cancel_button.show()
         self._cancel_button.set_sensitive(False)
         self._close_button.hide()
-        label=self._builder.get_object("spinnermessage")
-        label.set_text(message)
+        self._spinner_message.set_text(message)
         self._spinner.stop()
 
     def _show_error(self, error_message, error_details=None):
         self._main_nb.set_current_page(1)
         self._cancel_button.hide()
         self._close_button.show()
-        label=self._builder.get_object("errormessage")
-        label.set_text(error_message)
-        exp=self._builder.get_object("errorexp")
+        self._error_message.set_text(error_message)
         if error_details:
-            label=self._builder.get_object("errordetails")
-            label.set_text(error_details)
+            self._error_details.set_text(error_details)
         else:
-            exp.hide()
+            self._error_exp.hide()
 
     def _quit_cb(self, button):
         Gtk.main_quit()
@@ -178,8 +181,7 @@ class VMRunner(SingleApplication):
         self._cancel_button.show()
         self._cancel_button.set_sensitive(False)
         self._close_button.hide()
-        label=self._builder.get_object("spinnermessage")
-        label.set_text("Shutting down")
+        self._spinner_message.set_text("Shutting down")
 
     #
     # VM handling
@@ -205,7 +207,7 @@ class VMRunner(SingleApplication):
             self._main_window.show()
             self._proxy.stop(self._conf_id)
         except dbus.exceptions.DBusException:
-            if self._connect_dbus_proxy():
+            if self._connect_dbus_proxy(renew=True):
                 self._proxy.stop(self._conf_id)
                 self._vm_stopped()
             else:
@@ -232,7 +234,6 @@ class VMRunner(SingleApplication):
 
         try:
             viewer_config=self._proxy.get_ui_access(self._conf_id)
-            viewer_config=json.loads(viewer_config)
             vmui=VMUI.VMUI(viewer_config)
             vmui.actions.has_keyboard=False
             self._vmui_window=Gtk.Window()
@@ -280,5 +281,5 @@ args=parser.parse_args()
 
 dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
 obj=VMRunner(args.id, not args.noviewer)
-GLib.timeout_add(1, obj.start)
+GLib.idle_add(obj.start)
 Gtk.main()
@@ -20,13 +20,12 @@
 # along with FAIRSHELL.  If not, see <http://www.gnu.org/licenses/>.
 
 import sys
-import dbus
-import json
 import gi
 import argparse
 gi.require_version("Gtk", "3.0")
 from gi.repository import Gtk
 import VMUI
+import Utils as util
 
 # command line arguments
 parser=argparse.ArgumentParser()
@@ -35,9 +34,7 @@ parser.add_argument("--console-size", help="Leave the window's size to its defau
 args=parser.parse_args()
 
 # get the VM connection's parameters
-bus=dbus.SystemBus()
-obj=bus.get_object("org.fairshell.VMManager", "/remote/virtualmachines")
-proxy=dbus.Interface(obj, dbus_interface='org.fairshell.VMManager')
+proxy=util.get_vmmanager_proxy()
 
 # Gtk program
 def quit_cb(dummy, vmui):
@@ -53,7 +50,6 @@ def fullscreen_cb(self, fullscreen, main_window):
 try:
     win=Gtk.Window()
     viewer_config=proxy.get_ui_access(args.id)
-    viewer_config=json.loads(viewer_config)
     vmui=VMUI.VMUI(viewer_config)
     win.add(vmui)
     vmui.session_connect()
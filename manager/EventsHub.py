@@ -19,14 +19,16 @@
 
 #
 # This module allows one to integrate asynchronous components such as DBus services, GLib idle functions and
-# Pyinotify monitoring.
+# inotify monitoring.
 
-import time
+import os
 import uuid
+import struct
+import ctypes
+import ctypes.util
 import syslog
 import threading
-import psutil
-import pyinotify
+import concurrent.futures
 
 from gi.repository import GLib
 
@@ -39,22 +41,21 @@ class Cancelled(Exception):
 
 class Hub:
     def __init__(self):
-        self._components=[]
+        self._components={} # key=id(component), value=component (in registration order)
         dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
         self.loop=GLib.MainLoop()
 
     def register(self, component):
         """Register a component which events must be handled"""
         assert isinstance(component, Component)
-        if component not in self._components:
-            self._components+=[component]
+        if id(component) not in self._components:
+            self._components[id(component)]=component
             component._registered(self)
 
     def unregister(self, component):
         """Unregister a component"""
         assert isinstance(component, Component)
-        if component in self._components:
-            self._components.remove(component)
+        if self._components.pop(id(component), None) is not None:
             component._unregistered()
 
     def run(self):
@@ -66,12 +67,20 @@ class Hub:
         self.loop.run()
 
 class Component():
+    # threads running the jobs of all the components: the (possibly long) jobs started by job_run(), and the
+    # jobs run by job_run_wait() have their own threads so they never wait behind the former.
+    # Threads are only created when no idle one is available, and the job_run() limit is high enough for
+    # each running job (VM start, commit, etc.) to have its own thread, as when a thread was created per job
+    _pool=concurrent.futures.ThreadPoolExecutor(max_workers=64, thread_name_prefix="fairshell-job")
+    _sync_pool=concurrent.futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix="fairshell-sync-job")
+
     def __init__(self):
         self._async_threads={} # indexed by thread ID
         self._loop=None
 
         # sub thread execution
-        self._sync_thread=None
+        self._sync_job=None # concurrent.futures.Future of the job run by job_run_wait()
+        self._sync_done=None # threading.Event set (from the main loop) when the sub thread has finished
         self._result=None
         self._exception=None
 
@@ -97,6 +106,9 @@ class Component():
             self._result=func(args)
         except Exception as e:
             self._exception=e
+        finally:
+            # wake up the main loop waiting in job_run_wait()
+            GLib.idle_add(self._sync_done.set, priority=GLib.PRIORITY_DEFAULT)
 
     def job_run_wait(self, func, args):
         """Run a function (job) in a sub thread and waits for its completion, while at the same time still handling
@@ -105,20 +117,16 @@ class Component():
         * each component can only run one such synchronous thread
         * for DBus server objects, this function will block all other DBus calling methods
         """
-        if self._sync_thread:
+        if self._sync_job:
             raise Exception("Sub thead already in use")
-        self._sync_thread=threading.Thread(target=self._sub_sync_thread, args=(func, args))
-        self._sync_thread.start()
+        self._sync_done=threading.Event()
+        self._sync_job=Component._sync_pool.submit(self._sub_sync_thread, func, args)
         context=self._loop.get_context()
 
-        while True:
-            while context.pending():
-                context.iteration(False)
-            time.sleep(0.1)
-            if not self._sync_thread.is_alive():
-                self._sync_thread.join()
-                self._sync_thread=None
-                break
+        # handle events until the sub thread signals its completion
+        while not self._sync_done.is_set():
+            context.iteration(True)
+        self._sync_job=None
 
         if self._exception:
             raise self._exception
@@ -139,26 +147,24 @@ class Component():
             tdata["exception"]=e
         finally:
             tdata["finished"]=True
+            if tdata["callback"]:
+                GLib.idle_add(self._job_finished_cb, job_id, priority=GLib.PRIORITY_DEFAULT)
 
-    def _check_job_finished(self):
+    def _job_finished_cb(self, job_id):
+        # called from the main loop when a job has finished
         assert threading.current_thread()==threading.main_thread()
-        copy=list(self._async_threads.keys())
-        for job_id in copy:
-            try:
-                tdata=self._async_threads[job_id]
+        try:
+            tdata=self._async_threads.get(job_id) # job's result may already have been fetched
+            if tdata:
                 callback_func=tdata["callback"]
-                if callback_func and self.job_is_finished(job_id):
-                    callback_func(job_id)
+                if callback_func:
                     tdata["callback"]=None # so the callback is not executed several times
-            except Exception as e:
-                err="WARN: while checking jobs' status: %s"%str(e)
-                print(err)
-                syslog.syslog(syslog.LOG_WARNING, err)
-
-        if len(self._async_threads)==0:
-            return False # don't keep timer
-        else:
-            return True # keep timer
+                    callback_func(job_id)
+        except Exception as e:
+            err="WARN: while checking jobs' status: %s"%str(e)
+            print(err)
+            syslog.syslog(syslog.LOG_WARNING, err)
+        return False # remove the idle source
 
     def job_run(self, func, args, callback_func=None):
         """Run a function (job) in a sub thread, and returns a job ID.
@@ -176,21 +182,14 @@ class Component():
         it will also be called from the main thread."""
         assert threading.current_thread()==threading.main_thread()
         job_id=str(uuid.uuid4())
-        tdata={"thread": None,    # None when not started of already joined()
-               "finished": False, # True when thread has finished
+        tdata={"finished": False, # True when thread has finished
                "result": None,    # thread's actual result, if any
                "exception": None, # thread's raised exception, if any
                "callback": callback_func,  # callback function when the job is done, if any
-               "cancel": False}   # True when a cancel request has been made
+               "cancel": False,   # True when a cancel request has been made
+               "future": None}    # concurrent.futures.Future of the job
         self._async_threads[job_id]=tdata
-        thread=threading.Thread(target=self._sub_async_thread, args=(func, args, job_id))
-        tdata["thread"]=thread
-        thread.start()
-
-        # start timer if not yet started
-        if len(self._async_threads)==1:
-            GLib.timeout_add(500, self._check_job_finished)
-
+        tdata["future"]=Component._pool.submit(self._sub_async_thread, func, args, job_id)
         return job_id
 
     def job_cancel(self, job_id):
@@ -199,6 +198,12 @@ class Component():
             raise Exception("Unknown thread ID %s"%job_id)
         tdata=self._async_threads[job_id]
         tdata["cancel"]=True
+        if tdata["future"].cancel():
+            # the job was still queued and will never run
+            tdata["exception"]=Cancelled("Cancelled")
+            tdata["finished"]=True
+            if tdata["callback"]:
+                GLib.idle_add(self._job_finished_cb, job_id, priority=GLib.PRIORITY_DEFAULT)
 
     def job_is_finished(self, job_id):
         """Tell if a job started using job_run() has finished"""
@@ -217,9 +222,6 @@ class Component():
         tdata=self._async_threads[job_id]
 
         if tdata["finished"]:
-            if tdata["thread"]:
-                tdata["thread"].join() # to avoid stale threads
-                tdata["thread"]=None
             res=tdata["result"]
             exp=tdata["exception"]
             try:
@@ -233,6 +235,28 @@ class Component():
         else:
             raise Exception("Job is not yet finished")
 
+# inotify events (see inotify(7))
+IN_CLOSE_WRITE=0x00000008
+IN_MOVED_TO=0x00000080
+
+_inotify_event=struct.Struct("iIII") # struct inotify_event, without the name
+_libc=None
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc=ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    return _libc
+
+class InotifyEvent:
+    """Event passed to InotifyComponent.inotify_handler()"""
+    def __init__(self, wd, mask, cookie, name, pathname):
+        self.wd=wd
+        self.mask=mask
+        self.cookie=cookie
+        self.name=name # name of the file in the watched directory, or "" if the watched file itself
+        self.pathname=pathname # full path of the file
+
 class InotifyComponent(Component):
     """Component to monitor a set of directories or files.
     You need to:
@@ -241,41 +265,56 @@ class InotifyComponent(Component):
     """
     def __init__(self):
         Component.__init__(self)
-        self._wm=None
-        self._notifier=None
+        self._fd=None
         self._source=None
-        self._watched=[]
+        self._watched={} # key=watch descriptor, value=watched path
 
     def _inotify_process_events(self, source, condition):
-        #print("InoyifyComponent::_inotify_process_events()")
-        notifier=self._notifier
-        notifier.read_events()
-        notifier.process_events()
-        while notifier.check_events(10): # don't lock while waiting
-            notifier.read_events()
-            notifier.process_events()
-        #print("InoyifyComponent:: done")
+        # read all the pending events at once; if more events arrive in the meantime, GLib will
+        # call this function again
+        try:
+            data=os.read(self._fd, 65536)
+        except BlockingIOError:
+            return True
+        offset=0
+        while offset<len(data):
+            (wd, mask, cookie, length)=_inotify_event.unpack_from(data, offset)
+            offset+=_inotify_event.size
+            name=os.fsdecode(data[offset:offset+length].rstrip(b"\0"))
+            offset+=length
+            path=self._watched.get(wd)
+            if path is None:
+                continue # watch has been removed
+            pathname=os.path.join(path, name) if name else path
+            self.inotify_handler(InotifyEvent(wd, mask, cookie, name, pathname))
         return True
 
-    def watch(self, path, mask, rec=False, auto_add=False, do_glob=False, quiet=True, exclude_filter=None):
-        if not self._wm:
-            self._wm=pyinotify.WatchManager()
-            self._notifier=pyinotify.Notifier(self._wm, default_proc_fun=self.inotify_handler)
-            self._source=GLib.io_add_watch(self._notifier._fd, GLib.IO_IN, self._inotify_process_events)
-        self._watched+=[self._wm.add_watch(path, mask, rec, auto_add, do_glob, quiet, exclude_filter)]
+    def watch(self, path, mask):
+        """Monitor @path (a file or a directory) for the IN_* events in @mask"""
+        libc=_get_libc()
+        if self._fd is None:
+            fd=libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd<0:
+                raise Exception("Could not initialize inotify: %s"%os.strerror(ctypes.get_errno()))
+            self._fd=fd
+            self._source=GLib.io_add_watch(self._fd, GLib.IO_IN, self._inotify_process_events)
+        wd=libc.inotify_add_watch(self._fd, os.fsencode(path), ctypes.c_uint32(mask))
+        if wd<0:
+            raise Exception("Could not watch '%s': %s"%(path, os.strerror(ctypes.get_errno())))
+        self._watched[wd]=path
 
     def stop(self):
-        if not self._wm:
+        if self._fd is None:
             return
 
-        for watch in self._watched:
-            for path in watch:
-                self._wm.del_watch(watch[path])
-        self._watched=[]
+        libc=_get_libc()
+        for wd in self._watched:
+            libc.inotify_rm_watch(self._fd, wd)
+        self._watched={}
         GLib.source_remove(self._source)
         self._source=None
-        self._notifier=None
-        self._wm=None
+        os.close(self._fd)
+        self._fd=None
 
     def inotify_handler(self, event):
         raise Exception("inotify_handler() is a pure virtual function")
@@ -306,6 +345,11 @@ class DBusServer(Component, dbus.service.Object):
         """Get the UID and GID of the user having sent a command, using the @sender information"""
         dbus_info=dbus.Interface(bus.get_object("org.freedesktop.DBus", "/org/freedesktop/DBus/Bus", False),
                                  "org.freedesktop.DBus")
-        pid=dbus_info.GetConnectionUnixProcessID(sender) # also: GetConnectionUnixUser()
-        po=psutil.Process(pid)
-        return (po.uids().real, po.gids().real)
+        uid=int(dbus_info.GetConnectionUnixUser(sender))
+        pid=int(dbus_info.GetConnectionUnixProcessID(sender))
+        # the real GID is the first value of the "Gid:" line
+        with open("/proc/%d/status"%pid, "r") as file:
+            for line in file:
+                if line.startswith("Gid:"):
+                    return (uid, int(line.split()[1]))
+        raise Exception("Could not determine the GID of process %d"%pid)
@@ -19,24 +19,80 @@
 
 # This program manages a VM (start, destroy, etc.)
 
+import re
 import syslog
+import threading
 import netaddr
 import Utils as util
 
 # iptables timeout constant
 _iptables_lock_wait=20
 
-def _iptables_cmd(table, iptable_args, context):
+# beginning of the iptables command line for each table
+_iptables_prefixes={table: ("/sbin/iptables", "-w", str(_iptables_lock_wait), "-t", table) for table in ("nat", "filter")}
+
+# iptables errors meaning that the chain or rule to remove does not exist
+_not_found_re=re.compile(rb"Bad rule|No chain/target/match by that name\.")
+
+def _iptables_cmd(table, iptable_args, context, missing_ok=False):
+    """Run an iptables command, returns True if it succeeded, or False if the chain or rule it
+    applies to does not exist and @missing_ok is True"""
     assert table in ("nat", "filter")
-    args=["/sbin/iptables", "-w", str(_iptables_lock_wait), "-t", table]+iptable_args
-    (status, out, err)=util.exec_sync(args)
+    args=[*_iptables_prefixes[table], *iptable_args]
+    (status, out, err)=util.exec_sync(args, as_bytes=True) # output is only decoded if needed
     if status!=0:
-        msg="Iptables error while %s: %s"%(context, err)
+        if missing_ok and _not_found_re.search(err):
+            msg="Iptables %s: table %s, rule: %s: nothing to do"%(context, table, " ".join(iptable_args))
+            syslog.syslog(syslog.LOG_INFO, msg)
+            return False
+        msg="Iptables error while %s: %s"%(context, err.decode(errors="replace").strip())
         syslog.syslog(syslog.LOG_ERR, msg)
         raise Exception(msg)
     else:
         msg="Iptables %s: table %s, rule: %s"%(context, table, " ".join(iptable_args))
         syslog.syslog(syslog.LOG_INFO, msg)
+        return True
+
+def _iptables_restore(tables_rules, context):
+    """Apply several rules at once, without flushing the existing rules. @tables_rules is a dictionary
+    where keys are table names, and values are lists of lines in the iptables-restore format"""
+    data=""
+    for table in tables_rules:
+        assert table in ("nat", "filter")
+        data+="*%s\n%s\nCOMMIT\n"%(table, "\n".join(tables_rules[table]))
+    args=["/sbin/iptables-restore", "-w", str(_iptables_lock_wait), "--noflush"]
+    (status, out, err)=util.exec_sync(args, stdin_data=data)
+    if status!=0:
+        msg="Iptables error while %s: %s"%(context, err)
+        syslog.syslog(syslog.LOG_ERR, msg)
+        raise Exception(msg)
+    else:
+        for table in tables_rules:
+            msg="Iptables %s: table %s, rules: %s"%(context, table, "; ".join(tables_rules[table]))
+            syslog.syslog(syslog.LOG_INFO, msg)
+
+def install_rules(rules, vm_chain=None):
+    """Install several Rule objects at once, in the specified order, and if specified, the @vm_chain VMChain
+    before them (in the same iptables-restore call)"""
+    # the lock ensures the shared deny chain is not removed while the VM chain (which may jump to it)
+    # is being installed
+    with VMChain.deny_chain_lock:
+        tables_rules={}
+        if vm_chain:
+            assert isinstance(vm_chain, VMChain)
+            tables_rules[vm_chain.table]=vm_chain._restore_lines()
+            vm_chain._installed=None
+        for rule in rules:
+            assert isinstance(rule, Rule)
+            if rule._table not in tables_rules:
+                tables_rules[rule._table]=[]
+            tables_rules[rule._table]+=[rule.restore_line]
+            rule._installed=None
+        _iptables_restore(tables_rules, "setting up %d rules"%len(rules))
+        if vm_chain:
+            vm_chain._set_installed()
+        for rule in rules:
+            rule._installed=True
 
 class Chain:
     """Represents an iptables chain"""
@@ -45,6 +101,7 @@ class Chain:
         assert isinstance(chain_name, str)
         self._table=table
         self._name=chain_name
+        self._installed=None # last known installation status, None if unknown
 
     @property
     def table(self):
@@ -59,7 +116,12 @@ class Chain:
     @property
     def installed(self):
         """Tells if the chain is defined"""
-        args=["/sbin/iptables", "-w", str(_iptables_lock_wait), "-t", self._table, "-S", self._name]
+        if self._installed is None:
+            self._installed=self._check_installed()
+        return self._installed
+
+    def _check_installed(self):
+        args=[*_iptables_prefixes[self._table], "-S", self._name]
         (status, out, err)=util.exec_sync(args)
         if status==0:
             return True
@@ -71,38 +133,75 @@ class Chain:
     def install(self):
         """Install the chain"""
         if not self.installed:
+            self._installed=None
             _iptables_cmd(self._table, ["-N", self._name], "installing chain '%s'"%self._name)
+            self._installed=True
 
     def uninstall(self):
         """Uninstall the chain"""
-        if self.installed:
-            _iptables_cmd(self._table, ["-F", self._name], "flushing chain '%s'"%self._name)
-            _iptables_cmd(self._table, ["-X", self._name], "uninstalling chain '%s'"%self._name)
+        # if the status is unknown, don't check it first: try to flush the chain
+        if self._installed is not False:
+            self._installed=None
+            if _iptables_cmd(self._table, ["-F", self._name], "flushing chain '%s'"%self._name, missing_ok=True):
+                _iptables_cmd(self._table, ["-X", self._name], "uninstalling chain '%s'"%self._name)
+            self._installed=False
 
 class VMChain(Chain):
     """Represents the iptables chain used to filter the VM's communications"""
     chainindex=0
+    deny_chain=Chain("filter", "FAIRSHELL-VM-DENY") # logs and drops packets, shared by all the VM chains
+    deny_chain_users=0 # number of installed VM chains jumping to deny_chain
+    deny_chain_lock=threading.Lock() # protects deny_chain_users and the creation and removal of deny_chain
+
     def __init__(self, allowed_networks):
         assert isinstance(allowed_networks, list)
         # create chain
         VMChain.chainindex+=1
         Chain.__init__(self, "filter", "FAIRSHELL-VM-%s"%VMChain.chainindex)
         self._allowed_networks=allowed_networks
+        self._uses_deny_chain=False
+
+    def _restore_lines(self):
+        """Get the iptables-restore lines which (re)create the chain and all its rules at once: allow validated
+        networks, and jump to the shared chain to log and drop anything else (creating it if necessary).
+        VMChain.deny_chain_lock must be held"""
+        deny_name=VMChain.deny_chain.name
+        rules=[]
+        if VMChain.deny_chain_users==0:
+            # (re)define the shared chain, which may have been left over by a previous run
+            if not VMChain.deny_chain.installed:
+                rules+=[":%s - [0:0]"%deny_name]
+            rules+=["-F %s"%deny_name,
+                    "-A %s -j LOG --log-prefix \"FAIRSHELL-VM-BLOCKED-F \""%deny_name,
+                    "-A %s -j DROP"%deny_name]
+        rules+=[":%s - [0:0]"%self.name, "-F %s"%self.name]
+        rules+=["-A %s -d %s -j ACCEPT"%(self.name, netaddr.IPNetwork(net)) for net in self._allowed_networks]
+        rules+=["-A %s -j %s"%(self.name, deny_name)]
+        return rules
 
     def install(self):
-        Chain.install(self)
-
-        # remove any rule
-        _iptables_cmd(self.table, ["-F", self.name], "flushing chain '%s'"%self.name)
-        _iptables_cmd(self.table, ["-A", self.name, "-j", "LOG", "--log-prefix", "FAIRSHELL-VM-BLOCKED-F "], "installing chain '%s'"%self.name)
-        _iptables_cmd(self.table, ["-A", self.name, "-j", "DROP"], "installing chain '%s'"%self.name)
+        with VMChain.deny_chain_lock:
+            self._installed=None
+            _iptables_restore({self.table: self._restore_lines()}, "installing chain '%s'"%self.name)
+            self._set_installed()
+
+    def _set_installed(self):
+        """Record that the chain has been installed, VMChain.deny_chain_lock must be held"""
+        self._installed=True
+        VMChain.deny_chain._installed=True
+        if not self._uses_deny_chain:
+            self._uses_deny_chain=True
+            VMChain.deny_chain_users+=1
 
-        # allow validated networks
-        nets=self._allowed_networks.copy()
-        nets.reverse()
-        for net in nets:
-            network=netaddr.IPNetwork(net)
-            _iptables_cmd(self.table, ["-I", self.name, "-d", str(network), "-j", "ACCEPT"], "allow network %s"%net)
+    def uninstall(self):
+        with VMChain.deny_chain_lock:
+            Chain.uninstall(self)
+            if self._uses_deny_chain:
+                # the shared chain can only be removed once no other chain refers to it
+                self._uses_deny_chain=False
+                VMChain.deny_chain_users-=1
+                if VMChain.deny_chain_users==0:
+                    VMChain.deny_chain.uninstall()
 
 class Rule:
     """Represents a single iptables rule"""
@@ -112,11 +211,22 @@ class Rule:
         assert args[0] in ("-I", "-A")
         self._table=table
         self._args=args
+        self._installed=None # last known installation status, None if unknown
+
+    @property
+    def restore_line(self):
+        """The rule in the iptables-restore format"""
+        return " ".join('"%s"'%arg if " " in arg else arg for arg in self._args)
 
     @property
     def installed(self):
         """Tells if the rule is present"""
-        args=["/sbin/iptables", "-w", str(_iptables_lock_wait), "-t", self._table, "-C"]+self._args[1:]
+        if self._installed is None:
+            self._installed=self._check_installed()
+        return self._installed
+
+    def _check_installed(self):
+        args=[*_iptables_prefixes[self._table], "-C", *self._args[1:]]
         (status, out, err)=util.exec_sync(args)
         if status==0:
             return True
@@ -129,11 +239,16 @@ class Rule:
     def install(self):
         """Install the rule"""
         # we don't check if the rule is installed as it might already be, but at a wrong place
+        self._installed=None
         _iptables_cmd(self._table, self._args, "setting up rule '%s'"%" ".join(self._args))
+        self._installed=True
 
     def uninstall(self):
         """Uninstall the rule"""
-        if self.installed:
+        # if the status is unknown, don't check it first: try to remove the rule
+        if self._installed is not False:
             args=self._args.copy()
             args[0]="-D"
-            _iptables_cmd(self._table, args, "setting up rule")
+            self._installed=None
+            _iptables_cmd(self._table, args, "setting up rule", missing_ok=True)
+            self._installed=False
@@ -28,53 +28,146 @@ import json
 import enum
 import shutil
 import tempfile
+import threading
 import netaddr
 import xml.etree.ElementTree as ET
 import libvirt
 import Utils as util
 import EventsHub as evh
+try:
+    import nftables
+except ImportError:
+    nftables=None # the nft command will be used
 
-def _nft_cmd(verb, obj, nft_args, context):
+_nft_bin=shutil.which("nft", path="/usr/sbin:/sbin:/usr/bin:/bin") or "/sbin/nft" # used if libnftables is not available
+_nft=None # libnftables context, shared by all the objects
+_nft_lock=threading.Lock() # the context may be used from several jobs' threads
+
+_batch=threading.local() # "commands" attribute: list of (nft arguments, object) of the current thread's Batch
+
+def _nft_run(command):
+    """Runs nft command(s) (one per line, without the "nft" program name and options), and returns
+    (exit code, stdout, stderr).
+    The output includes the handles of the objects, and, for the "add" commands, the added objects.
+    If available, the libnftables library is used in-process, otherwise the nft program is executed"""
+    global _nft
+    if nftables is None:
+        return util.exec_sync([_nft_bin, "-a", "-e", "-f", "/dev/stdin"], stdin_data=command)
+    with _nft_lock:
+        if _nft is None:
+            _nft=nftables.Nftables()
+            _nft.set_handle_output(True)
+            _nft.set_echo_output(True)
+        (status, out, err)=_nft.cmd(command)
+    return (status, out.strip(), err.strip())
+
+def _nft_cmd(verb, obj, nft_args, context, want_handle=False, elements=False):
     """Runs the nft command
-    If @verb is "add", returns the new object's handle (as a string)
+    If @elements is True, the command applies to the elements of the @obj Set, and not to the set itself
+    If @want_handle is True, returns the new object's handle (as a string), or None if the command has
+    been queued in a Batch (the Rule's handle is set when the batch is executed)
+    If @verb is "delete" and the object does not exist (anymore), nothing is done (except in a Batch,
+    where the whole transaction fails)
     """
     assert verb in ("add", "delete")
     assert isinstance(nft_args, list)
     assert isinstance(context, str)
-    if verb=="add":
-        args=["/sbin/nft", "-a", "-e", verb] # so we can get the handle
-    else:
-        args=["/sbin/nft", verb]
-    if isinstance(obj, Table):
-        args+=["table", "ip", obj.name]
-    elif isinstance(obj, Chain):
-        args+=["chain", "ip", obj.table.name, obj.name]+nft_args
-    elif isinstance(obj, Rule):
-        args+=["rule", "ip", obj.table.name, obj.chain.name]+nft_args
-    else:
+    if not isinstance(obj, (Table, Chain, Set, Rule)):
         raise Exception("Unknown @obj type %s"%type(obj))
+    if elements:
+        assert isinstance(obj, Set)
+        args=[verb, "element"]+obj._nft_spec[1:]+nft_args
+    else:
+        args=[verb]+obj._nft_spec+nft_args
+
+    commands=getattr(_batch, "commands", None)
+    if commands is not None:
+        commands+=[(args, obj)]
+        return None
 
-    (status, out, err)=util.exec_sync(args)
+    (status, out, err)=_nft_run(" ".join(args))
     if status!=0:
+        if verb=="delete" and "No such file or directory" in err:
+            return None
         msg="nft error while %s: %s"%(context, err)
         syslog.syslog(syslog.LOG_ERR, msg)
         raise Exception(msg)
     else:
         handle=None
-        for line in out.splitlines():
-            if "# handle" in out:
-                parts=line.split()
-                handle=parts[-1]
-                break
+        if want_handle:
+            for line in out.splitlines():
+                if "# handle" in line:
+                    handle=line.split()[-1]
+                    break
         #msg="nft %s: %s"%(context, nft_args)
         #syslog.syslog(syslog.LOG_INFO, msg)
         return handle
 
+class Batch:
+    """Context manager which groups the add and delete operations made on Table, Chain and Rule objects
+    (from the current thread) in a single nft transaction, run when the context exits:
+        with Batch():
+            table.add()
+            ...
+    """
+    def __enter__(self):
+        if getattr(_batch, "commands", None) is not None:
+            raise Exception("nft batches can't be nested")
+        _batch.commands=[]
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        commands=_batch.commands
+        _batch.commands=None
+        if exc_type is not None or len(commands)==0:
+            return False
+
+        (status, out, err)=_nft_run("\n".join([" ".join(args) for (args, obj) in commands]))
+        if status!=0:
+            msg="nft error while running a batch of %d commands: %s"%(len(commands), err)
+            syslog.syslog(syslog.LOG_ERR, msg)
+            raise Exception(msg)
+
+        # the added rules are output in the same order as the commands, with their handle
+        rules=[obj for (args, obj) in commands if args[0]=="add" and isinstance(obj, Rule)]
+        handles=[line.split()[-1] for line in out.splitlines() if line.startswith("add rule ") and "# handle" in line]
+        if len(handles)==len(rules):
+            for (rule, handle) in zip(rules, handles):
+                rule._handle=handle
+        else:
+            # the transaction has been committed, don't fail
+            syslog.syslog(syslog.LOG_WARNING, "Could not get the handles of the %d added rules from the nft output, "
+                          "listing their chains"%len(rules))
+            _list_rules_handles(rules)
+        return False
+
+def _list_rules_handles(rules):
+    """Set the handles of the @rules, which have just been appended (in that order) to their chains, from
+    the listing of these chains"""
+    chains_rules={} # key=(table name, chain name), value=list of rules
+    for rule in rules:
+        key=(rule.table.name, rule.chain.name)
+        if key not in chains_rules:
+            chains_rules[key]=[]
+        chains_rules[key]+=[rule]
+    for ((table_name, chain_name), chain_rules) in chains_rules.items():
+        (status, out, err)=_nft_run("list chain ip %s %s"%(table_name, chain_name))
+        if status!=0:
+            # the rules can't be deleted individually, but are still removed with their table
+            syslog.syslog(syslog.LOG_ERR, "Could not list nft chain '%s': %s"%(chain_name, err))
+            continue
+        handles=[line.split()[-1] for line in out.splitlines()
+                 if "# handle" in line and not line.strip().startswith(("table ", "chain "))]
+        # the last rules of the chain are the ones which have just been appended
+        for (rule, handle) in zip(chain_rules, handles[-len(chain_rules):]):
+            rule._handle=handle
+
 class Table:
     """Represents an nftables IP table"""
     def __init__(self, name):
         assert isinstance(name, str) and name!=""
         self._name=name
+        self._nft_spec=["table", "ip", name] # identifies the object in nft commands
 
     @property
     def name(self):
@@ -84,9 +177,7 @@ class Table:
         _nft_cmd("add", self, [], "Table add")
 
     def delete(self):
-        (status, out, err)=util.exec_sync(["/sbin/nft", "list", "table", self._name])
-        if status==0:
-            _nft_cmd("delete", self, [], "Table delete")
+        _nft_cmd("delete", self, [], "Table delete")
 
 class Chain:
     """Represents a, nftable chain within a table"""
@@ -101,6 +192,13 @@ class Chain:
         self._type=ctype
         self._hook=hook
         self._priority=priority
+        self._nft_spec=["chain", "ip", table.name, name]
+        if ctype is None:
+            # regular chain
+            self._add_args=[]
+        else:
+            # base chain
+            self._add_args=["{", "type", ctype, "hook", hook, "priority", str(priority), ";", "}"]
 
     @property
     def table(self):
@@ -111,13 +209,41 @@ class Chain:
         return self._name
 
     def add(self):
-        if self._type is None:
-            # regular chain
-            args=[]
-        else:
-            # base chain
-            args=["{", "type", self._type, "hook", self._hook, "priority", str(self._priority), ";", "}"]
-        _nft_cmd("add", self, args, "Chain add")
+        _nft_cmd("add", self, self._add_args, "Chain add")
+
+class Set:
+    """Represents a named nftables set within a table, which rules can refer to as "@<name>" to match
+    any of its elements with a single (hashed) lookup, elements can be added and removed without
+    modifying the rules"""
+    def __init__(self, table, name, stype):
+        assert isinstance(table, Table)
+        assert isinstance(name, str) and name!=""
+        assert stype in ("ipv4_addr", "inet_service")
+        self._table=table
+        self._name=name
+        self._nft_spec=["set", "ip", table.name, name]
+        self._add_args=["{", "type", stype, ";", "}"]
+
+    @property
+    def table(self):
+        return self._table
+
+    @property
+    def name(self):
+        return self._name
+
+    def add(self):
+        _nft_cmd("add", self, self._add_args, "Set add")
+
+    def add_elements(self, elements):
+        """Add elements to the set (adding an element already present is not an error)"""
+        assert isinstance(elements, list) and len(elements)>0
+        _nft_cmd("add", self, ["{", ", ".join(elements), "}"], "Set elements add", elements=True)
+
+    def delete_elements(self, elements):
+        """Remove elements from the set"""
+        assert isinstance(elements, list) and len(elements)>0
+        _nft_cmd("delete", self, ["{", ", ".join(elements), "}"], "Set elements delete", elements=True)
 
 class Rule:
     """Represents a rule in an nftables chain"""
@@ -127,6 +253,7 @@ class Rule:
         self._chain=chain
         self._args=args
         self._handle=None
+        self._nft_spec=["rule", "ip", chain.table.name, chain.name]
 
     @property
     def table(self):
@@ -137,13 +264,11 @@ class Rule:
         return self._chain
 
     def add(self):
-        self._handle=_nft_cmd("add", self, self._args, "Rule add")
+        self._handle=_nft_cmd("add", self, self._args, "Rule add", want_handle=True)
 
     def delete(self):
         if self._handle is None:
             raise Exception("Rule has no handle")
         # if the chain does not exist anymore, nothing needs to be done
-        (status, out, err)=util.exec_sync(["/sbin/nft", "list", "chain", "ip", self.table.name, self.chain.name])
-        if status==0:
-            _nft_cmd("delete", self, ["handle", self._handle], "Rule delete")
+        _nft_cmd("delete", self, ["handle", self._handle], "Rule delete")
 
@@ -24,45 +24,50 @@ import subprocess
 import tempfile
 import sys
 import pwd
-import shutil
-import time
+import functools
 import distro
 import shlex
 import psutil
 import json
 import xdg.DesktopEntry
 
+_distrib=None
 def get_distrib():
     """Get the linux distribution, e.g. "fedora", "debian" or "ubuntu". """
-    pf=distro.linux_distribution(full_distribution_name=False)
-    return pf[0].lower()
+    global _distrib
+    if _distrib is None:
+        # only the ID is needed, linux_distribution() also computes the version and codename,
+        # which may require running lsb_release
+        _distrib=distro.id().lower()
+    return _distrib
 
 def write_data_to_file(data, filename, append=False, mode=None):
     """Creates a file with the specified data and filename"""
-    wmode="wb"
-    if append:
-        wmode="ab"
+    rdata=data.encode() if isinstance(data, str) else data
+    flags=os.O_WRONLY | os.O_CREAT | os.O_CLOEXEC | os.O_NOFOLLOW # don't write through a symlink
+    flags|=os.O_APPEND if append else os.O_TRUNC
 
     if mode:
         original_umask=os.umask(0)
-        opt=0
-        if append:
-            opt=os.O_APPEND
-        fd=os.open(filename, os.O_CREAT | os.O_RDWR | opt, mode)
-        os.umask(original_umask)
-        file=os.fdopen(fd, wmode)
-        stat=os.stat(filename)
-        if stat.st_mode & 0o777 !=mode:
-            raise Exception("Invalid permissions for '%s': expected %s and got %s"%(filename, oct(mode), oct(stat.st_wmode & 0o777)))
+        try:
+            fd=os.open(filename, flags, mode)
+        finally:
+            os.umask(original_umask)
+        # the mode is only applied if the file is created, check it if the file already existed
+        fmode=os.fstat(fd).st_mode & 0o777
+        if fmode!=mode:
+            os.close(fd)
+            raise Exception("Invalid permissions for '%s': expected %s and got %s"%(filename, oct(mode), oct(fmode)))
     else:
-        file=open(filename, wmode)
+        fd=os.open(filename, flags, 0o666)
 
-    rdata=data
-    if isinstance(rdata, str):
-        rdata=data.encode()
-    if rdata is not None:
-        file.write(rdata)
-    file.close()
+    try:
+        if rdata:
+            view=memoryview(rdata)
+            while view:
+                view=view[os.write(fd, view):]
+    finally:
+        os.close(fd)
 
 def load_file_contents(filename, binary=False):
     """Load the contents of a file in memory, as a string if @binary is False,
@@ -73,7 +78,7 @@ def load_file_contents(filename, binary=False):
         else:
             return file.read().decode()
 
-def exec_sync(args, stdin_data=None, as_bytes=False, exec_env=None, cwd=None, C_locale=False, timeout=None):
+def exec_sync(args, stdin_data=None, as_bytes=False, exec_env=None, cwd=None, C_locale=False, timeout=None, stdout_to=None):
     """Run a command and wait for it to terminate, returns (exit code, stdout, stderr)
     Notes:
     - @stdin_data allows to specify some input data, while @as_bytes specifies if the output data
@@ -82,37 +87,37 @@ def exec_sync(args, stdin_data=None, as_bytes=False, exec_env=None, cwd=None, C_
     - if @C_locale is True, then the LANG environment variable is set to "C" (useful when parsing output which
       repends on the locale)
     - if @timeout is specified, then the sub process is killed after that number of seconds and the return code is 250
+    - if @stdout_to is "devnull", then the sub process' stdout is discarded (and the returned stdout is empty),
+      otherwise (None or "pipe") it is handled according to @as_bytes
     """
     if C_locale:
         if exec_env:
             raise Exception("The @exec_env and @C_locale can't be both specified")
-        exec_env=os.environ.copy()
-        exec_env["LANG"]="C.UTF-8"
-        exec_env["LC_ALL"]="C.UTF-8"
+        exec_env={**os.environ, "LANG": "C.UTF-8", "LC_ALL": "C.UTF-8"}
 
-    # start process
+    # run process
     if as_bytes is None:
         outs=sys.stdout
         errs=sys.stderr
     else:
         outs=subprocess.PIPE
         errs=subprocess.PIPE
-    if stdin_data is None:
-        bdata=None
-        sub=subprocess.Popen(args, stdout=outs, stderr=errs, env=exec_env, cwd=cwd)
-    else:
-        bdata=stdin_data
-        if isinstance(bdata, str):
-            bdata=bdata.encode()
-        sub = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=outs, stderr=errs, env=exec_env, cwd=cwd)
-
-    # let process run
+    if stdout_to=="devnull":
+        outs=subprocess.DEVNULL
+    elif stdout_to not in (None, "pipe"):
+        raise Exception("Invalid @stdout_to value '%s'"%stdout_to)
+    bdata=stdin_data
+    if isinstance(bdata, str):
+        bdata=bdata.encode()
+    # when the output is captured, don't let the sub process read our own stdin
+    ins=subprocess.DEVNULL if bdata is None and as_bytes is not None else None
     try:
-        (out, err)=sub.communicate(input=bdata, timeout=timeout)
+        sub=subprocess.run(args, input=bdata, stdin=ins, stdout=outs, stderr=errs, env=exec_env, cwd=cwd, timeout=timeout)
+        (out, err)=(sub.stdout, sub.stderr)
         retcode=sub.returncode
-    except subprocess.TimeoutExpired:
-        sub.kill()
-        (out, err)=sub.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired as e:
+        # the sub process has been killed
+        (out, err)=(e.stdout, e.stderr)
         retcode=250
 
     # prepare returned values
@@ -122,8 +127,9 @@ def exec_sync(args, stdin_data=None, as_bytes=False, exec_env=None, cwd=None, C_
         sout=out
         serr=err
     else:
-        sout=re.sub (r'[\r\n]+$', '', out.decode()) if out else ""
-        serr=re.sub (r'[\r\n]+$', '', err.decode()) if err else ""
+        # remove the trailing new lines before decoding
+        sout=out.rstrip(b"\r\n").decode() if out else ""
+        serr=err.rstrip(b"\r\n").decode() if err else ""
 
     return (retcode, sout, serr)
 
@@ -131,24 +137,37 @@ def is_run_as_root():
     """Tell if the application is run as root or not"""
     return True if os.getuid()==0 else False
 
+@functools.lru_cache(maxsize=64)
+def get_user_pwent(uid):
+    """Get the password database entry of the @uid user (as returned by pwd.getpwuid()),
+    the entries are cached as user accounts very rarely change"""
+    return pwd.getpwuid(uid)
+
+@functools.lru_cache(maxsize=16)
+def get_user_uid(name):
+    """Get the UID of the @name user, cached like get_user_pwent()"""
+    return pwd.getpwnam(name).pw_uid
+
+_password_alphabet="abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
 def generate_password(length=25, alphabet=None):
     """Generate a random password containing letters and numbers, of the specified length (which can't be less than 12 characters)."""
     # https://www.pleacher.com/mp/mlessons/algebra/entropy.html
     if length<12:
         raise Exception("Can't generate a password with specified %d length"%length)
     if not alphabet:
-        import string
-        alphabet = string.ascii_letters + string.digits
+        alphabet=_password_alphabet
     elif len(alphabet)<26:
         raise Exception("Alphabet to generate password from is too small: %d long"%len(alphabet))
-    if sys.version_info >= (3,6):
-        # use the new Pyhton 3.6 secrets module
-        import secrets
-        return ''.join(secrets.choice(alphabet) for i in range(length))
-    else:
-        # fallbask to the random module
-        import random
-        return ''.join(random.choice(alphabet) for i in range(length))
+    elif len(alphabet)>256:
+        raise Exception("Alphabet to generate password from is too large: %d long"%len(alphabet))
+
+    # draw random bytes in bulk and discard the ones which would bias the modulo
+    import secrets
+    limit=256-256%len(alphabet)
+    chars=[]
+    while len(chars)<length:
+        chars+=[alphabet[byte%len(alphabet)] for byte in secrets.token_bytes(2*length) if byte<limit]
+    return "".join(chars[:length])
 
 def run_viewer(conf_id):
     """Starts the remote viewer and returns the subprocess.Popen of the remote viewer
@@ -174,40 +193,60 @@ def run_viewer(conf_id):
     else:
         args=["%s/fairshell-viewer.py"%os.path.dirname(__file__), conf_id]
     proc=subprocess.Popen(args, env=cenv, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    time.sleep(1)
-    if proc.poll()!=None:
-        raise Exception("Could not start viewer (%s)"%" ".join(args))
-    return proc
+    # the viewer exits within its first second if it can't start (e.g. wrong port or password),
+    # the wait ends as soon as it exits
+    try:
+        proc.wait(timeout=1)
+    except subprocess.TimeoutExpired:
+        return proc
+    raise Exception("Could not start viewer (%s)"%" ".join(args))
+
+_vmmanager_proxy=None
+def get_vmmanager_proxy(renew=False):
+    """Get a proxy to the VM manager's DBus object, on the (shared) system bus connection.
+    The same proxy is returned each time, unless @renew is True (for example when the VM manager
+    has been restarted)."""
+    global _vmmanager_proxy
+    if _vmmanager_proxy is None or renew:
+        import dbus
+        bus=dbus.SystemBus()
+        # no need to introspect the object, all the methods' arguments are strings
+        obj=bus.get_object("org.fairshell.VMManager", "/remote/virtualmachines", introspect=False)
+        _vmmanager_proxy=dbus.Interface(obj, dbus_interface="org.fairshell.VMManager")
+    return _vmmanager_proxy
+
+def _path_state(path):
+    """Get the (inode, ctime) of @path and of all its parent directories: they change if any of them is
+    replaced, or if its permissions or ownership change"""
+    path=os.path.abspath(path)
+    state=[]
+    while True:
+        st=os.stat(path)
+        state+=[(st.st_ino, st.st_ctime_ns)]
+        parent=os.path.dirname(path)
+        if parent==path:
+            return tuple(state)
+        path=parent
 
+_libvirt_readable=set() # (path, _path_state(path)) of the files known to be readable by the libvirt-qemu user
 def check_libvirt_readable(path):
-    testprog="""
-import sys
-try:
-    print("Testing %s"%sys.argv[1])
-    f=open(sys.argv[1], "r")
-    f.close()
-    exit(0)
-except Exception as e:
-    print("%s"%str(e))
-    exit(1)
-"""
-    tmptester=tempfile.NamedTemporaryFile()
-    tmptester.write(testprog.encode())
-    tmptester.flush()
-    shutil.chown(tmptester.name,  "libvirt-qemu")
-    args=["sudo", "-u", "libvirt-qemu", "/usr/bin/python3", tmptester.name, path]
-    (status, out, err)=exec_sync(args)
+    """Tell if @path can be read by the libvirt-qemu user"""
+    try:
+        key=(path, _path_state(path))
+    except OSError:
+        return False
+    if key in _libvirt_readable:
+        return True
+    (status, out, err)=exec_sync(["sudo", "-u", "libvirt-qemu", "/usr/bin/test", "-r", path])
     if status==0:
+        _libvirt_readable.add(key)
         return True
     else:
         return False
 
+_iso_extensions=(".iso", ".img")
 def is_iso(path):
-    lpath=path.lower()
-    if lpath.endswith(".iso") or lpath.endswith(".img"):
-        return True
-    else:
-        return False
+    return path.lower().endswith(_iso_extensions)
 
 def get_iso_images_list(files_list, resources_dir=None):
     """Ensures all resources are available:
@@ -247,74 +286,71 @@ def get_iso_images_list(files_list, resources_dir=None):
         args=["genisoimage", "-iso-level", "4", "-o", tmpiso.name]
         for path in extra_iso_contents:
             args+=[path]
-        (status, out, err)=exec_sync(args)
+        (status, out, err)=exec_sync(args, stdout_to="devnull")
         if status!=0:
             raise Exception("Could not create ISO image: %s"%err)
         isofiles+=[tmpiso.name]
 
     return (isofiles, tmpiso)
 
+def _get_mounts():
+    """Get the mounted file systems, from /proc/self/mountinfo, as a list of
+    (major:minor, mount point, file system type, source, super options) tuples"""
+    unescape=lambda value: re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), value)
+    mounts=[]
+    for line in load_file_contents("/proc/self/mountinfo").splitlines():
+        # line will be like: 36 35 98:0 / /mnt2 rw,noatime master:1 - ext3 /dev/vda3 rw,errors=continue
+        (left, right)=line.split(" - ", 1)
+        lparts=left.split(" ")
+        rparts=right.split(" ")
+        mounts+=[(lparts[2], unescape(lparts[4]), rparts[0], unescape(rparts[1]), rparts[2])]
+    return mounts
+
 def get_root_live_partition(exception_if_no_live=True):
     """Get the live partition from which the system has booted.
     Returns devfile, for ex.: /dev/vda3"""
     # get the overlay's 'lower dir'
-    (status, out, err)=exec_sync(["mount"])
-    if status!=0:
-        raise Exception("Could not list mount points: %s"%err)
-    mounts=out
-    ovline=None
-    for line in mounts.splitlines():
-        if line.startswith("overlay on / type overlay "):
-            #  line will be like: overlay on / type overlay (rw,noatime,lowerdir=/run/live/rootfs/filesystem.squashfs/,upperdir=/run/live/overlay/rw,workdir=/run/live/overlay/work)
-            ovline=line
+    mounts=_get_mounts()
+    ovopts=None
+    for (devnum, mountpoint, fstype, source, options) in mounts:
+        if mountpoint=="/" and fstype=="overlay":
+            # options will be like: rw,lowerdir=/run/live/rootfs/filesystem.squashfs/,upperdir=/run/live/overlay/rw,workdir=/run/live/overlay/work
+            ovopts=options
             break
-    if ovline is None:
+    if ovopts is None:
         if exception_if_no_live:
             raise Exception("Could not identify the overlay filesystem")
         return None
 
-    parts=re.split(r'\(|\)', ovline)
-    params=re.split(r',', parts[1])
-    found=False
-    for param in params:
-        if param.startswith("lowerdir="):
-            (dummy, lowerdir)=param.split("=")
-            # dir will be something like "/run/live/rootfs/filesystem.squashfs/"
-            found=True
-            break
-    if not found:
+    # lowerdir will be something like "/run/live/rootfs/filesystem.squashfs/"
+    lowerdir=next((param[9:] for param in ovopts.split(",") if param.startswith("lowerdir=")), None)
+    if lowerdir is None:
         raise Exception("Could not identify overlay's lower dir")
 
     # get the loop device associated with the overlay's lower dir
     loopdev=None
     if lowerdir[-1]=="/":
         lowerdir=lowerdir[:-1]
-    for line in mounts.splitlines():
-        if "on %s type squashfs"%lowerdir in line:
-            (loopdev, dummy)=line.split(" ", 1)
+    for (devnum, mountpoint, fstype, source, options) in mounts:
+        if mountpoint==lowerdir and fstype=="squashfs":
+            loopdev=source
             break
     if loopdev!="/dev/loop0": # at this point, should always be loop0, otherwise something is very wrong...
         raise Exception("Unexpected loop device '%s'"%loopdev)
 
     # get the file serving as backend for the loopdev
-    (status, out, err)=exec_sync(["/sbin/losetup", "-l", "-J", loopdev]) # as JSON!
-    if status!=0:
-        raise Exception("Could not list loop devices set up: %s"%err)
-    data=json.loads(out)
-    backend=data["loopdevices"][0]["back-file"]
+    try:
+        backend=load_file_contents("/sys/block/loop0/loop/backing_file").strip()
+    except Exception as e:
+        raise Exception("Could not get the file backing %s: %s"%(loopdev, str(e)))
 
     # get the mounted device partition holding that backend file
-    (status, out, err)=exec_sync(["df", os.path.dirname(backend)]) # use the dirname and not the file itself for access permissions issues
-    if status!=0:
-        raise Exception("Could not use df: %s"%err)
-    first=True
-    for line in out.splitlines():
-        if first:
-            first=False
-        else:
-            (devfile, dummy)=line.split(" ", 1)
+    st=os.stat(os.path.dirname(backend)) # use the dirname and not the file itself for access permissions issues
+    devnum="%d:%d"%(os.major(st.st_dev), os.minor(st.st_dev))
+    for (mdevnum, mountpoint, fstype, devfile, options) in mounts:
+        if mdevnum==devnum:
             # devfile will be like "/dev/vda3"
-            if not devfile.startswith("/dev/vd") and not devfile.startswith("/dev/sd"):
+            if not devfile.startswith(("/dev/vd", "/dev/sd")):
                 raise Exception("Invalid boot partition '%s'"%devfile)
             return devfile
     raise Exception("Internal error: boot partition is not mounted, where is the '%s' file ???"%backend)
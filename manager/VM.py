@@ -23,35 +23,135 @@ import os
 import syslog
 import re
 import time
-import pwd
 import grp
 import json
 import enum
 import shutil
-import tempfile
 import netaddr
 import threading
+import concurrent.futures
+import socket
+import http.client
+import urllib.parse
 import xml.etree.ElementTree as ET
 import libvirt
 import Utils as util
 import EventsHub as evh
 
-# determine if iptables or nftables must be used
-system_is_nftables=True
-try:
-    (status, out, err)=util.exec_sync(["/sbin/iptables", "--version"])
-    if status!=0:
-        raise Exception("Could not execute /sbin/iptables: %s"%err)
-    if "legacy" in out or not os.path.exists("/sbin/nft"):
-        system_is_nftables=False
-except FileNotFoundError:
-    pass
+# determine if iptables or nftables must be used: /sbin/iptables is a symlink to either
+# xtables-legacy-multi or xtables-nft-multi (possibly through the alternatives system)
+system_is_nftables=os.path.exists("/sbin/nft") and "legacy" not in os.path.basename(os.path.realpath("/sbin/iptables"))
 print("Using nftables: %s"%system_is_nftables)
 if system_is_nftables:
     import NetworkNftables as nft
 else:
     import NetworkIptables as nip
 
+_mac_addr_re=re.compile(r'^([a-f0-9][a-f0-9]:){5}[a-f0-9][a-f0-9]$')
+_usb_redir_keywords=frozenset(("all", "mass-storage", "smartcard"))
+_kvm_module_dirs=("/sys/module/kvm_intel", "/sys/module/kvm_amd", "/sys/module/kvm") # present if KVM is loaded
+_vmconfig_keys=frozenset(("vm-imagefile", "os-variant", "descr", "shared-dir", "writable", "hardware", "allowed-users",
+                          "resolved-names", "allowed-networks", "display", "usb-redir")) # mandatory configuration attributes
+
+_libvirt_conn=None # connection to the libvirt daemon, shared by all the objects
+_libvirt_conn_lock=threading.Lock()
+
+# domains' states, key=domain name, value=State, removed when libvirt reports a lifecycle event
+# for the domain (and the state is then queried again when needed)
+_domain_states={}
+_domain_events={} # key=domain name, value=number of lifecycle events received for the domain
+
+_libvirt_events=False # True once init_libvirt_events() has been called
+
+def _run_libvirt_events():
+    while True:
+        libvirt.virEventRunDefaultImpl()
+
+def init_libvirt_events():
+    """Run libvirt's event loop in a dedicated thread, so the domains' states can be cached until libvirt reports
+    a change. Must be called once, before any connection to libvirt is opened (without it, the states are
+    queried each time)"""
+    global _libvirt_events
+    if _libvirt_events:
+        return
+    libvirt.virEventRegisterDefaultImpl()
+    threading.Thread(target=_run_libvirt_events, name="libvirt-events", daemon=True).start()
+    _libvirt_events=True
+
+def _domain_lifecycle_cb(conn, dom, event, detail, opaque):
+    name=dom.name()
+    _domain_events[name]=_domain_events.get(name, 0)+1
+    _domain_states.pop(name, None)
+
+def _libvirt_conn_closed_cb(conn, reason, opaque):
+    # forget the connection right away, for example if the libvirt daemon has been restarted
+    global _libvirt_conn
+    with _libvirt_conn_lock:
+        _libvirt_conn=None
+        _domain_states.clear()
+
+def _get_libvirt_conn():
+    """Get the connection to the libvirt daemon, opened when first needed or if it was lost"""
+    global _libvirt_conn
+    with _libvirt_conn_lock:
+        if _libvirt_conn is None or not _libvirt_conn.isAlive():
+            # events may have been missed
+            _domain_states.clear()
+            _libvirt_conn=libvirt.open("qemu:///system")
+            if _libvirt_events:
+                _libvirt_conn.setKeepAlive(5, 3)
+                _libvirt_conn.registerCloseCallback(_libvirt_conn_closed_cb, None)
+                _libvirt_conn.domainEventRegisterAny(None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, _domain_lifecycle_cb, None)
+        return _libvirt_conn
+
+def _lookup_domain(name):
+    """Get the libvirt domain named @name, or None if it is not defined"""
+    try:
+        return _get_libvirt_conn().lookupByName(name)
+    except libvirt.libvirtError as e:
+        if e.get_error_code()==libvirt.VIR_ERR_NO_DOMAIN:
+            return None
+        raise
+
+def _is_str_list(value):
+    """Tell if @value is a list of strings"""
+    return isinstance(value, list) and all(isinstance(entry, str) for entry in value)
+
+def _ensure_dir(path, mode):
+    """Create the @path directory if it does not exist, and make sure its permissions are @mode"""
+    try:
+        if os.stat(path).st_mode & 0o777==mode:
+            return
+    except FileNotFoundError:
+        os.makedirs(path, exist_ok=True)
+    os.chmod(path, mode)
+
+def _create_concurrently(objects, what, cancel_requested_func):
+    """Call the create() method of all the @objects, which must be independent, concurrently, and raise
+    a single exception for all the failures, if any.
+    A cancel request is checked before each object's creation is started and each time one has finished
+    (the creations already started are then waited for)"""
+    cancelled=False
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(objects)) as executor:
+        futures=[]
+        for obj in objects:
+            if cancel_requested_func and cancel_requested_func():
+                cancelled=True
+                break
+            futures+=[executor.submit(obj.create)]
+        if not cancelled:
+            for future in concurrent.futures.as_completed(futures):
+                if cancel_requested_func and cancel_requested_func():
+                    cancelled=True
+                    for pending in futures:
+                        pending.cancel()
+                    break
+    if cancelled:
+        raise evh.Cancelled("Cancelled")
+    errors=[str(future.exception()) for future in futures if future.exception()]
+    if errors:
+        raise Exception("Could not create the VM's %s: %s"%(what, ", ".join(errors)))
+
 def _check_mount_directory(path):
     rpath=os.path.realpath(path)
     if not os.access(path, os.X_OK):
@@ -80,11 +180,12 @@ class VMConfig:
         self._index=VMConfig.confindex
 
         self._id=id
-        for key in ("vm-imagefile", "os-variant", "descr", "shared-dir", "writable", "hardware", "allowed-users",
-                    "resolved-names", "allowed-networks", "display", "usb-redir"):
-            if key not in conf_data:
-                raise Exception(f"Invalid VM '{id}' configuration: no '{key}' attribute")
-        self._conf=conf_data
+        if not isinstance(conf_data, dict):
+            raise Exception(f"Invalid VM '{id}' configuration")
+        missing=_vmconfig_keys-conf_data.keys()
+        if missing:
+            missing="', '".join(sorted(missing))
+            raise Exception(f"Invalid VM '{id}' configuration: no '{missing}' attribute")
 
         key="vm-imagefile"
         value=conf_data[key]
@@ -92,6 +193,7 @@ class VMConfig:
             raise Exception(f"Invalid VM '{id}', configuration attribute '{key}'")
         if image_file_must_exist and not os.path.isfile(value):
             raise Exception(f"Invalid VM '{id}': VM image does not exist")
+        self._base_image_file=value
 
         key="os-variant"
         value=conf_data[key]
@@ -103,11 +205,13 @@ class VMConfig:
         value=conf_data[key]
         if not isinstance(value, str):
             raise Exception(f"Invalid VM '{id}', configuration attribute '{key}'")
+        self._descr=value
 
         key="shared-dir"
         value=conf_data[key]
         if value is not None and not isinstance(value, str):
             raise Exception(f"Invalid VM '{id}', configuration attribute '{key}'")
+        self._shared_dir=value
 
         key="display"
         value=conf_data[key]
@@ -124,6 +228,7 @@ class VMConfig:
         value=conf_data[key]
         if not isinstance(value, bool):
             raise Exception(f"Invalid VM '{id}', configuration attribute '{key}'")
+        self._writable=value
 
         key="hardware"
         value=conf_data[key]
@@ -133,7 +238,7 @@ class VMConfig:
             self._memsize_g=float(value["mem"])/1024
             self._nb_cpus=int(value["cpu"])
             self._mac_addr=value["mac-addr"]
-            if self._mac_addr and not re.match(r'^([a-f0-9][a-f0-9]:){5}[a-f0-9][a-f0-9]$', self._mac_addr):
+            if self._mac_addr and not _mac_addr_re.match(self._mac_addr):
                 raise Exception()
         except Exception:
             raise Exception(f"Invalid VM '{id}', configuration attribute '{key}'")
@@ -147,33 +252,29 @@ class VMConfig:
             self._usb_redir=[]
         else:
             for p in parts:
-                if p not in ("all", "mass-storage", "smartcard"):
+                if p not in _usb_redir_keywords:
                     raise Exception(f"Invalid VM '{id}', configuration attribute '{key}'")
             self._usb_redir=parts
 
         key="allowed-users"
         value=conf_data[key]
-        if not isinstance(value, list):
+        if not _is_str_list(value):
             raise Exception(f"Invalid VM '{id}', configuration attribute '{key}'")
-        for entry in value:
-            if not isinstance(entry, str):
-                raise Exception(f"Invalid VM '{id}', configuration attribute '{key}'")
+        self._all_users_allowed=value==[""]
+        self._allowed_users=frozenset([entry for entry in value if not entry.startswith("@")])
+        self._allowed_groups=[entry[1:] for entry in value if entry.startswith("@")]
 
         key="resolved-names"
         value=conf_data[key]
-        if not isinstance(value, list):
+        if not _is_str_list(value):
             raise Exception(f"Invalid VM '{id}', configuration attribute '{key}'")
-        for svalue in value:
-            if not isinstance(svalue, str):
-                raise Exception(f"Invalid VM '{id}', configuration attribute '{key}'")
+        self._resolved_names=value
 
         key="allowed-networks"
         value=conf_data[key]
-        if not isinstance(value, list):
+        if not _is_str_list(value):
             raise Exception(f"Invalid VM '{id}', configuration attribute '{key}'")
-        for svalue in value:
-            if not isinstance(svalue, str):
-                raise Exception(f"Invalid VM '{id}', configuration attribute '{key}'")
+        self._allowed_networks=value
 
         self._extra_iso_images=[]
         self._iso_boot=None
@@ -185,12 +286,12 @@ class VMConfig:
 
     @property
     def descr(self):
-        return self._conf["descr"]
+        return self._descr
 
     @property
     def base_image_file(self):
         """Base VM image file"""
-        return self._conf["vm-imagefile"]
+        return self._base_image_file
 
     @property
     def os_variant(self):
@@ -205,7 +306,7 @@ class VMConfig:
     @property
     def shared_dir(self):
         """Directory which is shared between the host and the VM"""
-        return self._conf["shared-dir"]
+        return self._shared_dir
 
     @property
     def memsize_g(self):
@@ -233,18 +334,18 @@ class VMConfig:
     @property
     def writable(self):
         """Tells if the base VM image can be modified by commiting a runtime overlay"""
-        return self._conf["writable"]
+        return self._writable
 
     @property
     def resolved_names(self):
         """List the names which are allowed to be resolved"""
-        return self._conf["resolved-names"]
+        return self._resolved_names
 
     @property
     def allowed_networks(self):
         """List the networks with which the VM can communicate (independently of the IP addresses resolved
         which are also allowed)"""
-        return self._conf["allowed-networks"]
+        return self._allowed_networks
 
     @property
     def extra_iso_images(self):
@@ -269,23 +370,20 @@ class VMConfig:
 
     def user_allowed(self, uid, gid):
         """Tells if the uid.gid user is allowed to use the configuration"""
-        all_allowed=self._conf["allowed-users"]
-        if all_allowed==[""]:
+        if self._all_users_allowed:
             return True
 
         # test if username specified AS-IS
-        user=pwd.getpwuid(uid)
-        if user.pw_name in all_allowed:
+        user=util.get_user_pwent(uid)
+        if user.pw_name in self._allowed_users:
             return True
 
         # test if user is part of a group which is allowed
-        for entry in all_allowed:
-            if entry[0]!="@":
-                continue
+        for group in self._allowed_groups:
             try:
-                gr=grp.getgrnam(entry[1:])
+                gr=grp.getgrnam(group)
             except:
-                syslog.syslog(syslog.LOG_ERR, "unknown group %s"%entry[1:])
+                syslog.syslog(syslog.LOG_ERR, "unknown group %s"%group)
                 continue
 
             if user.pw_name in gr.gr_mem:
@@ -312,6 +410,9 @@ class Network:
         index=Network.netindex
         net="192.168.%d.0/24"%index
         self._network=netaddr.IPNetwork(net)
+        self._cidr=str(self._network)
+        self._netmask=str(self._network.netmask)
+        self._ips={} # key=IP index, value=IP address as a str
         self._name="fairshell%s"%index
         self._iface=self._name
 
@@ -341,12 +442,21 @@ class Network:
     @property
     def cidr(self):
         """CIRD of the network, as a str"""
-        return str(self._network)
+        return self._cidr
+
+    @property
+    def netmask(self):
+        """Netmask of the network, as a str"""
+        return self._netmask
 
     def get_ip(self, index):
         """Get an IP address for the specified index system by comibining the CIDR with the
         requested IP index"""
-        return str(self._network[index])
+        ip=self._ips.get(index)
+        if ip is None:
+            ip=str(self._network[index])
+            self._ips[index]=ip
+        return ip
 
 class VirtNetwork(Network):
     """Libvirt network, created and destroyed on the fly (not persistant)"""
@@ -380,38 +490,74 @@ class VirtNetwork(Network):
         """
         Network.__init__(self)
         self._nat=nat
+        # the network's definition never changes
+        template=VirtNetwork.xml_nat if nat else VirtNetwork.xml_direct
+        self._xml=template%(self.name, self._iface, self.get_ip(1), self.netmask, self.get_ip(5), self.get_ip(10))
+
+    def _lookup_net(self):
+        """Get the libvirt network, or None if it does not exist"""
+        try:
+            return _get_libvirt_conn().networkLookupByName(self.name)
+        except libvirt.libvirtError as e:
+            if e.get_error_code()==libvirt.VIR_ERR_NO_NETWORK:
+                return None
+            syslog.syslog(syslog.LOG_ERR, "Could not look up virt. network '%s': %s"%(self.name, str(e)))
+            raise Exception("Could not look up virt. network '%s': %s"%(self.name, str(e)))
 
     def _net_exists(self):
         """Tells if network exists"""
-        (status, out, err)=util.exec_sync(["virsh", "net-list", "--all"], C_locale=True)
-        if status!=0:
-            syslog.syslog(syslog.LOG_ERR, "Could not list virt. networks: %s"%err)
-            raise Exception("Could not list virt. networks: %s"%err)
-        return self.name in out
+        return self._lookup_net() is not None
 
     def create(self):
         if not self._net_exists():
-            net=self._network
-            if self._nat:
-                xml_data=VirtNetwork.xml_nat%(self.name, self._iface, net[1], net.netmask, net[5], net[10])
-            else:
-                xml_data=VirtNetwork.xml_direct%(self.name, self._iface, net[1], net.netmask, net[5], net[10])
-
-            tmpfile=tempfile.NamedTemporaryFile()
-            tmpfile.write(xml_data.encode())
-            tmpfile.flush()
-            (status, out, err)=util.exec_sync(["virsh", "net-create", tmpfile.name], C_locale=True)
-            if status!=0:
-                syslog.syslog(syslog.LOG_ERR, "Could not define virt. network '%s': %s"%(self.name, err))
-                raise Exception("Could not define virt. network '%s': %s"%(self.name, err))
+            try:
+                _get_libvirt_conn().networkCreateXML(self._xml)
+            except libvirt.libvirtError as e:
+                syslog.syslog(syslog.LOG_ERR, "Could not define virt. network '%s': %s"%(self.name, str(e)))
+                raise Exception("Could not define virt. network '%s': %s"%(self.name, str(e)))
 
     def destroy(self):
-        if self._net_exists():
+        net=self._lookup_net()
+        if net:
             # stop network
-            (status, out, err)=util.exec_sync(["virsh", "net-destroy", self.name], C_locale=True)
-            if status!=0:
-                syslog.syslog(syslog.LOG_ERR, "Could not destroy virt. network '%s': %s"%(self.name, err))
-                raise Exception("Could not destroy virt. network '%s': %s"%(self.name, err))
+            try:
+                net.destroy()
+            except libvirt.libvirtError as e:
+                syslog.syslog(syslog.LOG_ERR, "Could not destroy virt. network '%s': %s"%(self.name, str(e)))
+                raise Exception("Could not destroy virt. network '%s': %s"%(self.name, str(e)))
+
+_docker_socket="/var/run/docker.sock"
+
+class _DockerAPIConnection(http.client.HTTPConnection):
+    """HTTP connection to the Docker daemon's UNIX socket"""
+    def __init__(self):
+        http.client.HTTPConnection.__init__(self, "localhost", timeout=120)
+
+    def connect(self):
+        self.sock=socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(_docker_socket)
+
+def _docker_api(method, path):
+    """Run a Docker Engine API request (see https://docs.docker.com/engine/api/), where @path is like
+    "/containers/<name>/json" (with <name> URL quoted).
+    Returns (HTTP status, decoded JSON response or None)"""
+    conn=_DockerAPIConnection()
+    try:
+        conn.request(method, path)
+        resp=conn.getresponse()
+        data=resp.read()
+        if data and resp.getheader("Content-Type", "").startswith("application/json"):
+            return (resp.status, json.loads(data))
+        return (resp.status, None)
+    finally:
+        conn.close()
+
+def _docker_api_error(status, data):
+    """Get the error message of a failed Docker Engine API request"""
+    if isinstance(data, dict) and "message" in data:
+        return data["message"]
+    return "HTTP status %d"%status
 
 class DockerNetwork(Network):
     """Docker network"""
@@ -420,16 +566,16 @@ class DockerNetwork(Network):
 
     def _net_exists(self):
         """Tells if network exists"""
-        (status, out, err)=util.exec_sync(["docker", "network", "inspect", self.name])
-        if status==0:
+        (status, data)=_docker_api("GET", "/networks/%s"%urllib.parse.quote(self.name))
+        if status==200:
             # Docker network exists
             return True
-        else:
-            if "No such network" not in err:
-                msg="Could not test if Docker network '%s' exists"%self.name
-                syslog.syslog(syslog.LOG_ERR, msg)
-                raise Exception(msg)
+        elif status==404:
             return False
+        else:
+            msg="Could not test if Docker network '%s' exists: %s"%(self.name, _docker_api_error(status, data))
+            syslog.syslog(syslog.LOG_ERR, msg)
+            raise Exception(msg)
 
     def create(self):
         if not self._net_exists():
@@ -454,6 +600,19 @@ class DockerContainer:
     """Represents a Docker container"""
     index=0
     images_dir="/usr/share/fairshell/virt-system/docker-images"
+    _image_ids=None # contents of the image-ids.json file, loaded when first needed
+    _loaded_images=set() # (image name, image ID) of the images known to be loaded in Docker
+    _image_locks={} # key=(image name, image ID), value=threading.Lock held while the image is being loaded
+    _loaded_images_lock=threading.Lock() # protects _loaded_images and _image_locks
+
+    @classmethod
+    def _load_image_ids(cls):
+        """Get the Docker image IDs from the image-ids.json file, which is generated when 'compiling' the resources
+        and is like: {"fairshell-smb": "5589bf49aae0", "fairshell-unbound": "184edf88e011"}"""
+        if cls._image_ids is None:
+            jids=util.load_file_contents("%s/image-ids.json"%cls.images_dir)
+            cls._image_ids=json.loads(jids)
+        return cls._image_ids
 
     def __init__(self, image_name, network, ip_index, image_id=None, env=None, shared_dirs=None):
         if not isinstance(network, DockerNetwork):
@@ -469,10 +628,8 @@ class DockerContainer:
         self._env=env if env else {}
         self._shared_dirs=shared_dirs if shared_dirs else []
 
-        # determine the exatc image ID from the image-ids.json is generated when 'compiling' the resources
-        # which is like: {"fairshell-smb": "5589bf49aae0", "fairshell-unbound": "184edf88e011"}
-        jids=util.load_file_contents("%s/image-ids.json"%DockerContainer.images_dir)
-        ids=json.loads(jids)
+        # determine the exact image ID
+        ids=DockerContainer._load_image_ids()
         if not image_name in ids:
             raise Exception("Missing Docker ID for Docker image '%s'"%image_name)
         self._image_id=ids[image_name]
@@ -485,16 +642,60 @@ class DockerContainer:
     def ip(self):
         return self._network.get_ip(self._ip_index)
 
+    def _inspect(self):
+        """Get the container's low level information (as returned by docker inspect), or None
+        if the container does not exist"""
+        (status, data)=_docker_api("GET", "/containers/%s/json"%urllib.parse.quote(self._cont_name))
+        if status==404:
+            return None
+        if status!=200:
+            err=_docker_api_error(status, data)
+            syslog.syslog(syslog.LOG_ERR, "Could not get Docker container '%s''s state: %s"%(self._cont_name, err))
+            raise Exception("Could not get Docker container '%s''s state: %s"%(self._cont_name, err))
+        return data
+
+    def _remove(self):
+        """Remove the container if it exists, even if it is running"""
+        (status, data)=_docker_api("DELETE", "/containers/%s?force=1"%urllib.parse.quote(self._cont_name))
+        if status not in (204, 404):
+            err=_docker_api_error(status, data)
+            syslog.syslog(syslog.LOG_ERR, "Could not remove stale Docker container '%s': %s"%(self._cont_name, err))
+            raise Exception("Could not remove stale Docker container '%s': %s"%(self._cont_name, err))
+
     def _ensure_image_loaded(self):
-        (status, out, err)=util.exec_sync(["docker", "images", "--format", "{{.ID}}", self._image_name])
-        if status!=0:
+        key=(self._image_name, self._image_id)
+        with DockerContainer._loaded_images_lock:
+            if key in DockerContainer._loaded_images:
+                return
+            image_lock=DockerContainer._image_locks.setdefault(key, threading.Lock())
+
+        # only the containers using the same image wait for each other
+        with image_lock:
+            with DockerContainer._loaded_images_lock:
+                if key in DockerContainer._loaded_images:
+                    return # loaded while waiting for the lock
+            self._load_image()
+            with DockerContainer._loaded_images_lock:
+                DockerContainer._loaded_images.add(key)
+
+    def _load_image(self):
+        """Make sure the image with the expected ID is loaded in Docker"""
+        qname=urllib.parse.quote(self._image_name)
+        (status, data)=_docker_api("GET", "/images/%s/json"%qname)
+        if status==200:
+            # the full ID is like "sha256:<64 hex digits>", image-ids.json holds the short (12 digits) ID
+            current_id=data["Id"].split(":")[-1][:12]
+        elif status==404:
+            current_id=None
+        else:
+            err=_docker_api_error(status, data)
             syslog.syslog(syslog.LOG_ERR, "Could not list Docker images: %s"%err)
             raise Exception("Could not list Docker images: %s"%err)
-        if self._image_id and out!=self._image_id:
-            if out:
-                (status, out, err)=util.exec_sync(["docker", "rmi", self._image_name])
-                if status!=0:
-                    syslog.syslog(syslog.LOG_ERR, "Could not delete Docker image '%s': %s"%(self._image_name, err))
+        if self._image_id and current_id!=self._image_id:
+            if current_id:
+                (status, data)=_docker_api("DELETE", "/images/%s"%qname)
+                if status!=200:
+                    syslog.syslog(syslog.LOG_ERR, "Could not delete Docker image '%s': %s"%(self._image_name, _docker_api_error(status, data)))
 
             if not os.path.exists(self._image_file):
                 syslog.syslog(syslog.LOG_ERR, "Missing Docker image file '%s'"%self._image_file)
@@ -507,18 +708,11 @@ class DockerContainer:
 
     def create(self):
         # if container exists but is not UP, destroy it
-        (status, out, err)=util.exec_sync(["docker", "ps", "-a", "-f", "name=%s"%self._cont_name, "--format", "{{.Status}}"])
-        if status!=0:
-            syslog.syslog(syslog.LOG_ERR, "Could not list running Docker containers: %s"%err)
-            raise Exception("Could not list running Docker containers: %s"%err)
-        if out.startswith("Up "):
+        data=self._inspect()
+        if data and data["State"]["Running"]:
             return
-        elif out and out!="\n":
-            # remove container
-            (status, out, err)=util.exec_sync(["docker", "rm", "-f", self._cont_name])
-            if status!=0:
-                syslog.syslog(syslog.LOG_ERR, "Could not remove stale Docker container '%s': %s"%(self._cont_name, err))
-                raise Exception("Could not remove stale Docker container '%s': %s"%(self._cont_name, err))
+        elif data:
+            self._remove()
 
         # ensure Docker image is loaded
         self._ensure_image_loaded()
@@ -537,37 +731,31 @@ class DockerContainer:
         (status, out, err)=util.exec_sync(args)
         if status!=0:
             syslog.syslog(syslog.LOG_ERR, "Could not start Docker container '%s': %s"%(self._cont_name, err))
-            util.exec_sync(["docker", "rm", "-f", self._cont_name]) # cleanup, to avoid stale containers in the created state
+            with DockerContainer._loaded_images_lock:
+                DockerContainer._loaded_images.discard((self._image_name, self._image_id)) # check the image again next time
+            try:
+                self._remove() # cleanup, to avoid stale containers in the created state
+            except Exception:
+                pass
             raise Exception("Could not start Docker container '%s': %s"%(self._cont_name, err))
 
     def destroy(self):
         """Remove the container"""
-        (status, out, err)=util.exec_sync(["docker", "ps", "-a", "-f", "name=%s"%self._cont_name,
-                                           "--format", "{{.Status}}"])
-        if status!=0:
-            syslog.syslog(syslog.LOG_ERR, "Could not list running Docker containers: %s"%err)
-            raise Exception("Could not list running Docker containers: %s"%err)
-
-        # remove container
-        if out and out!="\n":
-            (status, out, err)=util.exec_sync(["docker", "rm", "-f", self._cont_name])
-            if status!=0:
-                syslog.syslog(syslog.LOG_ERR, "Could not remove stale Docker container '%s': %s"%(self._cont_name, err))
-                raise Exception("Could not remove stale Docker container '%s': %s"%(self._cont_name, err))
+        self._remove()
 
     def get_environ(self):
-        args=["docker", "inspect", "--format={{range .Config.Env}}{{println .}}{{end}}", self._cont_name]
-        (status, out, err)=util.exec_sync(args)
-        if status!=0:
-            err="Could not get container '%s''s environment variables: %s"%(self._cont_name, err)
+        data=self._inspect()
+        if data is None:
+            err="Could not get container '%s''s environment variables: no such container"%self._cont_name
             syslog.syslog(syslog.LOG_ERR, err)
             raise Exception(err)
 
+        # entries are like "NAME=value", where value may also contain "="
         env={}
-        for line in out.splitlines():
-            parts=line.split("=")
-            if len(parts)==2:
-                env[parts[0]]=parts[1]
+        for entry in data["Config"]["Env"] or []:
+            (name, sep, value)=entry.partition("=")
+            if sep:
+                env[name]=value
         return env
 
 class VM():
@@ -592,6 +780,8 @@ class VM():
             raise Exception("VM access denied")
 
         self._lock=threading.Lock()
+        self._spice_port=None # cached while the VM runs
+        self._spice_listen=None # address the Spice server listens on, cached along with the port
         self._state=State.STOPPED
         self._config=config
         self._config_id=config.id
@@ -600,26 +790,22 @@ class VM():
         self._gid=int(gid)
 
         base="/run/fairshell-virt-system"
-        os.makedirs(base, exist_ok=True)
-        os.chmod(base, 0o700)
+        _ensure_dir(base, 0o700)
 
         self._run_dir="%s/%s"%(base, self._config_id)
-        os.makedirs(self._run_dir, exist_ok=True)
-        os.chmod(self._run_dir, 0o700)
+        _ensure_dir(self._run_dir, 0o700)
 
         base="/var/log/fairshell-virt-system" # hard coded in the systemd unit file
-        os.makedirs(base, exist_ok=True)
-        os.chmod(base, 0o700)
+        _ensure_dir(base, 0o700)
 
         self._logs_dir="%s/%s"%(base, self._config_id)
-        os.makedirs(self._logs_dir, exist_ok=True)
-        os.chmod(self._logs_dir, 0o777)
+        _ensure_dir(self._logs_dir, 0o777)
 
         self._resolved_dir="%s/resolved"%self._run_dir
-        os.makedirs(self._resolved_dir, exist_ok=True)
-        os.chmod(self._resolved_dir, 0o777)
+        _ensure_dir(self._resolved_dir, 0o777)
 
         self._resolv_file="%s/resolv.json"%self._run_dir
+        self._dns_servers=None # last DNS servers written to self._resolv_file
         if not os.path.exists(self._resolv_file):
             self.set_dns_servers(["1.1.1.1"])
 
@@ -666,6 +852,10 @@ class VM():
         self._container_smb=None # defined at run time
 
         # define networks' filtering rules
+        vm_if=self._net_virt.interface
+        smb_if=self._net_dock_smb.interface
+        dns_if=self._net_dock_dns.interface
+        dns_ip=self._container_dns.ip
         if system_is_nftables:
             # using nftables
             self._nft_table=nft.Table(self._config.dom_name)
@@ -677,6 +867,8 @@ class VM():
             vm_ext=nft.Chain(self._nft_table, "vm-ext", "filter", "forward")
             dns=nft.Chain(self._nft_table, "dns", "filter", "forward")
             smb=nft.Chain(self._nft_table, "smb", "filter", "forward")
+            # resolved IP addresses the VM may connect to, see vm-manager's AllowedIPs
+            self._nft_allowed_ips=nft.Set(self._nft_table, "allowed-ips", "ipv4_addr")
             self._nft_chains=[
                 vm_dns_nat,
                 host_input,
@@ -687,84 +879,90 @@ class VM():
                 smb
             ]
             self._nft_rules=[
-                nft.Rule(vm_dns_nat, ["iif", self._net_virt.interface, "udp", "dport", "53", "counter", "dnat", self._container_dns.ip]),
+                nft.Rule(vm_dns_nat, ["iif", vm_if, "udp", "dport", "53", "counter", "dnat", dns_ip]),
 
-                nft.Rule(host_input, ["iif", self._net_virt.interface, "udp", "dport", "67", "counter", "accept"]),
-                nft.Rule(host_input, ["iif", self._net_virt.interface, "ct", "state", "related,established", "accept"]),
-                nft.Rule(host_input, ["iif", "{", self._net_virt.interface, ",", self._net_dock_smb.interface, ",", self._net_dock_dns.interface, "}", "counter", "log", "drop"]),
+                nft.Rule(host_input, ["iif", vm_if, "udp", "dport", "67", "counter", "accept"]),
+                nft.Rule(host_input, ["iif", vm_if, "ct", "state", "related,established", "accept"]),
+                nft.Rule(host_input, ["iif", "{", vm_if, ",", smb_if, ",", dns_if, "}", "counter", "log", "drop"]),
 
-                nft.Rule(host_output, ["oif", self._net_virt.interface, "udp", "dport", "68", "counter", "accept"]),
-                nft.Rule(host_output, ["oif", "{", self._net_virt.interface, ",", self._net_dock_smb.interface, ",", self._net_dock_dns.interface, "}", "counter", "log", "drop"]),
+                nft.Rule(host_output, ["oif", vm_if, "udp", "dport", "68", "counter", "accept"]),
+                nft.Rule(host_output, ["oif", "{", vm_if, ",", smb_if, ",", dns_if, "}", "counter", "log", "drop"]),
 
-                nft.Rule(vm_ext, ["iif", self._net_virt.interface, "oif", "!=", "{", self._net_dock_smb.interface, ",", self._net_dock_dns.interface, "}", "jump", "vm-ext-allow"]),
-                nft.Rule(vm_ext, ["iif", self._net_virt.interface, "oif", "!=", "{", self._net_dock_smb.interface, ",", self._net_dock_dns.interface, "}", "counter", "log", "drop"]),
+                nft.Rule(vm_ext, ["iif", vm_if, "oif", "!=", "{", smb_if, ",", dns_if, "}", "jump", "vm-ext-allow"]),
+                nft.Rule(vm_ext, ["iif", vm_if, "oif", "!=", "{", smb_if, ",", dns_if, "}", "counter", "log", "drop"]),
 
-                nft.Rule(dns, ["iif", self._net_virt.interface, "oif", self._net_dock_dns.interface, "udp", "dport", "53", "accept"]),
-                nft.Rule(dns, ["iif", self._net_dock_dns.interface, "oif", self._net_virt.interface, "udp", "sport", "53", "accept"]),
-                nft.Rule(dns, ["iif", self._net_virt.interface, "oif", self._net_dock_dns.interface, "tcp", "dport", "53", "accept"]),
-                nft.Rule(dns, ["iif", self._net_dock_dns.interface, "oif", self._net_virt.interface, "tcp", "sport", "53", "accept"]),
-                nft.Rule(dns, ["iif", self._net_dock_dns.interface, "oif", "{", self._net_virt.interface, ",", self._net_dock_smb.interface, "}", "counter", "log", "drop"]),
-                nft.Rule(dns, ["iif", "{", self._net_virt.interface, ",", self._net_dock_smb.interface, "}", "oif", self._net_dock_dns.interface, "counter", "log", "drop"]),
+                nft.Rule(dns, ["iif", vm_if, "oif", dns_if, "udp", "dport", "53", "accept"]),
+                nft.Rule(dns, ["iif", dns_if, "oif", vm_if, "udp", "sport", "53", "accept"]),
+                nft.Rule(dns, ["iif", vm_if, "oif", dns_if, "tcp", "dport", "53", "accept"]),
+                nft.Rule(dns, ["iif", dns_if, "oif", vm_if, "tcp", "sport", "53", "accept"]),
+                nft.Rule(dns, ["iif", dns_if, "oif", "{", vm_if, ",", smb_if, "}", "counter", "log", "drop"]),
+                nft.Rule(dns, ["iif", "{", vm_if, ",", smb_if, "}", "oif", dns_if, "counter", "log", "drop"]),
     
-                nft.Rule(smb, ["iif", self._net_virt.interface, "oif", self._net_dock_smb.interface, "tcp", "dport", "445", "accept"]),
-                nft.Rule(smb, ["iif", self._net_dock_smb.interface, "oif", self._net_virt.interface, "ct", "state", "related,established", "accept"]),
-                nft.Rule(smb, ["oif", self._net_dock_smb.interface, "counter", "log", "drop"]),
-                nft.Rule(smb, ["iif", self._net_dock_smb.interface, "counter", "log", "drop"])
+                nft.Rule(smb, ["iif", vm_if, "oif", smb_if, "tcp", "dport", "445", "accept"]),
+                nft.Rule(smb, ["iif", smb_if, "oif", vm_if, "ct", "state", "related,established", "accept"]),
+                nft.Rule(smb, ["oif", smb_if, "counter", "log", "drop"]),
+                nft.Rule(smb, ["iif", smb_if, "counter", "log", "drop"])
             ]
             self._filter_chain=vm_ext_allow
-            for cidr in self._config.allowed_networks:
-                rule=nft.Rule(vm_ext_allow, ["ip", "daddr", cidr, "accept"])
-                self._nft_rules+=[rule]
+            self._nft_rules+=[nft.Rule(vm_ext_allow, ["ip", "daddr", "@%s"%self._nft_allowed_ips.name, "accept"])]
+            if len(self._config.allowed_networks)>0:
+                # a single lookup in an anonymous set instead of one rule per network (overlapping or
+                # adjacent networks are merged first, nft refuses a set with conflicting intervals)
+                try:
+                    cidrs=", ".join([str(net) for net in netaddr.cidr_merge(self._config.allowed_networks)])
+                except Exception as e:
+                    raise Exception("Invalid allowed network: %s"%str(e))
+                self._nft_rules+=[nft.Rule(vm_ext_allow, ["ip", "daddr", "{", cidrs, "}", "accept"])]
         else:
             # using iptables
             self._filter_chain=nip.VMChain(self._config.allowed_networks)
             self._iptables_rules=[
                 # Communications from the host
-                nip.Rule("filter", ["-I", "OUTPUT", "-o", self._net_virt.interface, "-j", "DROP"]),
-                nip.Rule("filter", ["-I", "OUTPUT", "-o", self._net_virt.interface,
+                nip.Rule("filter", ["-I", "OUTPUT", "-o", vm_if, "-j", "DROP"]),
+                nip.Rule("filter", ["-I", "OUTPUT", "-o", vm_if,
                                     "-j", "LOG", "--log-prefix", "FAIRSHELL-VM-BLOCKED-VM-IN "]),
 
-                nip.Rule("filter", ["-I", "OUTPUT", "-o", self._net_dock_smb.interface, "-j", "DROP"]),
-                nip.Rule("filter", ["-I", "OUTPUT", "-o", self._net_dock_smb.interface,
+                nip.Rule("filter", ["-I", "OUTPUT", "-o", smb_if, "-j", "DROP"]),
+                nip.Rule("filter", ["-I", "OUTPUT", "-o", smb_if,
                                     "-j", "LOG", "--log-prefix", "FAIRSHELL-VM-BLOCKED-SMB-IN "]),
 
-                nip.Rule("filter", ["-I", "OUTPUT", "-o", self._net_dock_dns.interface, "-j", "DROP"]),
-                nip.Rule("filter", ["-I", "OUTPUT", "-o", self._net_dock_dns.interface,
+                nip.Rule("filter", ["-I", "OUTPUT", "-o", dns_if, "-j", "DROP"]),
+                nip.Rule("filter", ["-I", "OUTPUT", "-o", dns_if,
                                     "-j", "LOG", "--log-prefix", "FAIRSHELL-VM-BLOCKED-DNS-IN "]),
 
                 # Communications from the VM
                 # redirect all VM' DNS queries to the local DNS server
-                nip.Rule("nat", ["-I", "PREROUTING", "-i", self._net_virt.interface, "-p", "udp", "-m", "udp", "--dport", "53",
-                                 "-j", "DNAT", "--to-destination", self._container_dns.ip]),
-                nip.Rule("nat", ["-I", "PREROUTING", "-i", self._net_virt.interface, "-p", "tcp", "-m", "tcp", "--dport", "53",
-                                 "-j", "DNAT", "--to-destination", self._container_dns.ip]),
+                nip.Rule("nat", ["-I", "PREROUTING", "-i", vm_if, "-p", "udp", "-m", "udp", "--dport", "53",
+                                 "-j", "DNAT", "--to-destination", dns_ip]),
+                nip.Rule("nat", ["-I", "PREROUTING", "-i", vm_if, "-p", "tcp", "-m", "tcp", "--dport", "53",
+                                 "-j", "DNAT", "--to-destination", dns_ip]),
 
                 # allow the VM to only perform DHCP requests to the host
-                nip.Rule("filter", ["-I", "INPUT", "-i", self._net_virt.interface, "-j", "DROP"]),
-                nip.Rule("filter", ["-I", "INPUT", "-i", self._net_virt.interface, "-j", "LOG",
+                nip.Rule("filter", ["-I", "INPUT", "-i", vm_if, "-j", "DROP"]),
+                nip.Rule("filter", ["-I", "INPUT", "-i", vm_if, "-j", "LOG",
                                     "--log-prefix", "FAIRSHELL-VM-BLOCKED-I "]),
 
-                nip.Rule("filter", ["-I", "INPUT", "-i", self._net_virt.interface, "-p", "udp", "-m", "udp", "--dport", "67", "-j", "ACCEPT"]),
-                nip.Rule("filter", ["-I", "OUTPUT", "-o", self._net_virt.interface, "-p", "udp", "-m", "udp", "--dport", "68", "-j", "ACCEPT"]),
+                nip.Rule("filter", ["-I", "INPUT", "-i", vm_if, "-p", "udp", "-m", "udp", "--dport", "67", "-j", "ACCEPT"]),
+                nip.Rule("filter", ["-I", "OUTPUT", "-o", vm_if, "-p", "udp", "-m", "udp", "--dport", "68", "-j", "ACCEPT"]),
 
                 # allow the VM to only open connections to the DNS and SMB server
-                nip.Rule("filter", ["-I", "FORWARD", "-i", self._net_virt.interface, "-j", self._filter_chain.name]),
-                nip.Rule("filter", ["-I", "FORWARD", "-i", self._net_virt.interface, "-p", "udp", "-m", "udp", "--dport", "53",
-                                    "-o", self._net_dock_dns.interface, "-j", "ACCEPT"]),
-                nip.Rule("filter", ["-I", "FORWARD", "-i", self._net_virt.interface, "-p", "tcp", "-m", "tcp", "--dport", "445",
-                                    "-o", self._net_dock_smb.interface, "-j", "ACCEPT"]),
+                nip.Rule("filter", ["-I", "FORWARD", "-i", vm_if, "-j", self._filter_chain.name]),
+                nip.Rule("filter", ["-I", "FORWARD", "-i", vm_if, "-p", "udp", "-m", "udp", "--dport", "53",
+                                    "-o", dns_if, "-j", "ACCEPT"]),
+                nip.Rule("filter", ["-I", "FORWARD", "-i", vm_if, "-p", "tcp", "-m", "tcp", "--dport", "445",
+                                    "-o", smb_if, "-j", "ACCEPT"]),
 
                 # Communications from the DNS server
-                #nip.Rule("filter", ["-I", "FORWARD", "-i", self._net_dock_dns.interface, "-p", "udp", "-m", "udp", "!", "--sport", "53", "-j", "DROP"]),
-                #nip.Rule("filter", ["-I", "FORWARD", "-i", self._net_dock_dns.interface, "-p", "udp", "-m", "udp", "!", "--sport", "53",
+                #nip.Rule("filter", ["-I", "FORWARD", "-i", dns_if, "-p", "udp", "-m", "udp", "!", "--sport", "53", "-j", "DROP"]),
+                #nip.Rule("filter", ["-I", "FORWARD", "-i", dns_if, "-p", "udp", "-m", "udp", "!", "--sport", "53",
                 #                         "-j", "LOG", "--log-prefix", "FAIRSHELL-VM-BLOCKED-DNS-OUT "]),
 
                 # Communications from the SMB server
-                nip.Rule("filter", ["-I", "FORWARD", "-i", self._net_dock_smb.interface, "-j", "DROP"]),
-                nip.Rule("filter", ["-I", "FORWARD", "-i", self._net_dock_smb.interface,
+                nip.Rule("filter", ["-I", "FORWARD", "-i", smb_if, "-j", "DROP"]),
+                nip.Rule("filter", ["-I", "FORWARD", "-i", smb_if,
                                     "-j", "LOG", "--log-prefix", "FAIRSHELL-VM-BLOCKED-SMB-OUT "]),
 
-                nip.Rule("filter", ["-I", "FORWARD", "-i", self._net_dock_smb.interface,
+                nip.Rule("filter", ["-I", "FORWARD", "-i", smb_if,
                                     "-m", "conntrack", "--ctstate", "RELATED,ESTABLISHED", "-j", "ACCEPT"]),
             ]
 
@@ -795,6 +993,14 @@ class VM():
         else:
             return None
 
+    @property
+    def allow_set_name(self):
+        """Name of the FW set of the IP addresses the VM is allowed to connect to"""
+        if system_is_nftables:
+            return self._nft_allowed_ips.name
+        else:
+            return None
+
     @property
     def allow_chain_name(self):
         """Name of the FW chain used to filter communications for the VM"""
@@ -822,23 +1028,31 @@ class VM():
 
         # NB: the Docker container's status is not used here, only the VM is handled
         vm_name=self._config.dom_name
-        (status, out, err)=util.exec_sync(["virsh", "-q", "list"], C_locale=True)
-        if status==0:
-            self._state=State.STOPPED
-            for line in out.splitlines():
-                parts=line.split()
-                if len(parts)==3 and parts[1]==vm_name:
-                    if parts[2]=="running":
-                        self._state=State.RUNNING
-                    else:
-                        self._state=State.PARTIAL
-                    break
-
+        try:
+            _get_libvirt_conn() # make sure the connection (and the events reporting) is alive
+            state=_domain_states.get(vm_name)
+            if state is None:
+                nb_events=_domain_events.get(vm_name, 0)
+                dom=_lookup_domain(vm_name)
+                if dom is None or not dom.isActive():
+                    state=State.STOPPED
+                elif dom.state()[0]==libvirt.VIR_DOMAIN_RUNNING:
+                    state=State.RUNNING
+                else:
+                    state=State.PARTIAL
+                # don't cache a state which may already be outdated, or which changes would not be reported
+                if _libvirt_events and _domain_events.get(vm_name, 0)==nb_events:
+                    _domain_states[vm_name]=state
+            self._state=state
+        except libvirt.libvirtError as e:
+            self._state=None
+            syslog.syslog(syslog.LOG_ERR, "Can't get the VM's state: %s"%str(e))
+        else:
+            if self._state==State.STOPPED:
+                self._spice_port=None
+                self._spice_listen=None
             if self._state!=current and self._state==State.STOPPED:
                self._vm_infra_stop()
-        else:
-            self._state=None
-            syslog.syslog(syslog.LOG_ERR, "Can't get list of running VMs")
 
         self._lock.release()
 
@@ -853,28 +1067,42 @@ class VM():
         """
         if not isinstance(dns_servers, list):
             raise Exception("CODEBUG: invalid @dns_servers argument: %s"%dns_servers)
+        if dns_servers==self._dns_servers:
+            return # avoid notifying the DNS server for nothing
         print("Setting DNS servers to: %s"%json.dumps(dns_servers))
         util.write_data_to_file(json.dumps(dns_servers), self._resolv_file)
+        self._dns_servers=dns_servers.copy()
 
     def get_spice_listening_port(self):
         """Get the port on which the Spice server is listening for the VM"""
-        conn=libvirt.open("qemu:///system")
-        dom=conn.lookupByName(self._config.dom_name)
-        xml=dom.XMLDesc()
-        root=ET.fromstring(xml)
-        nodes=root.findall("./devices/graphics")
-        for node in nodes:
-            if node.attrib["type"]=="spice":
-                return int(node.attrib["port"])
-        return None
+        # the port is allocated when the VM starts and does not change while it runs
+        if self._spice_port is None:
+            dom=_get_libvirt_conn().lookupByName(self._config.dom_name)
+            node=ET.fromstring(dom.XMLDesc()).find("./devices/graphics[@type='spice']")
+            if node is None:
+                return None
+            port=int(node.attrib["port"])
+            if port<=0:
+                return port # not yet allocated, don't cache it
+            self._spice_port=port
+            listen=node.attrib.get("listen")
+            if listen is None:
+                lnode=node.find("./listen[@type='address']")
+                if lnode is not None:
+                    listen=lnode.attrib.get("address")
+            if listen in (None, "", "0.0.0.0", "::"):
+                listen="127.0.0.1" # libvirt's default, or listening on all the interfaces
+            self._spice_listen=listen
+        return self._spice_port
 
     def _check_vm_base_image_file(self):
         # check that the VM's base image file exists and is owned by libvirt
-        if not os.path.exists(self._config.base_image_file):
+        try:
+            st=os.stat(self._config.base_image_file)
+        except FileNotFoundError:
             syslog.syslog(syslog.LOG_INFO, "VM image file '%s' does not exist"%self._config.base_image_file)
             raise Exception("VM image file '%s' does not exist"%self._config.base_image_file)
 
-        owner=pwd.getpwuid(os.stat(self._config.base_image_file).st_uid).pw_name
         distrib=util.get_distrib()
         if distrib in ("debian", "ubuntu"):
             expowner="libvirt-qemu"
@@ -882,11 +1110,12 @@ class VM():
             expowner="qemu"
         else:
             raise Exception("Unsupported Linux OS flavour '%s'"%distrib)
-        if owner!=expowner:
+        if st.st_uid!=util.get_user_uid(expowner):
             shutil.chown(self._config.base_image_file, expowner)
 
         # ensure image access permissions
-        os.chmod(self._config.base_image_file, 0o600)
+        if st.st_mode & 0o777!=0o600:
+            os.chmod(self._config.base_image_file, 0o600)
 
     def get_run_imagefile(self):
         """Get the image file name used by the VM"""
@@ -900,13 +1129,11 @@ class VM():
         """Start the infrastructure associated to the VM: networkd and services in a Docker container"""
         try:
             # start libvirt's & Docker networks
-            for net in (self._net_virt, self._net_dock_smb, self._net_dock_dns):
-                net.create()
-                if cancel_requested_func and cancel_requested_func():
-                    raise evh.Cancelled("Cancelled")
+            _create_concurrently((self._net_virt, self._net_dock_smb, self._net_dock_dns), "networks",
+                                 cancel_requested_func)
 
             # check directory to share with the VM
-            home_dir=pwd.getpwuid(self._uid).pw_dir
+            home_dir=util.get_user_pwent(self._uid).pw_dir
             shared_dir=None
             if self._config.shared_dir:
                 if os.path.isabs(self._config.shared_dir):
@@ -933,27 +1160,22 @@ class VM():
                     "mode": "rw"
                 }
             ]
+            # (in case of error, _vm_infra_stop() removes the containers which have been created)
             self._container_smb=DockerContainer("fairshell-smb", self._net_dock_smb, 100, env=env, shared_dirs=shared)
-            try:
-                for cont in (self._container_smb, self._container_dns):
-                    cont.create()
-                    if cancel_requested_func and cancel_requested_func():
-                        raise evh.Cancelled("Cancelled")
-            except Exception as e:
-                self._container_smb=None
-                raise e
+            _create_concurrently((self._container_smb, self._container_dns), "Docker containers",
+                                 cancel_requested_func)
 
             # setup netfilter rules
             if system_is_nftables:
-                self._nft_table.add()
-                for chain in self._nft_chains:
-                    chain.add()
-                for rule in self._nft_rules:
-                    rule.add()
+                with nft.Batch():
+                    self._nft_table.add()
+                    for chain in self._nft_chains:
+                        chain.add()
+                    self._nft_allowed_ips.add()
+                    for rule in self._nft_rules:
+                        rule.add()
             else:
-                self._filter_chain.install()
-                for obj in self._iptables_rules:
-                    obj.install()
+                nip.install_rules(self._iptables_rules, vm_chain=self._filter_chain)
         except Exception as e:
             self._vm_infra_stop()
             raise e
@@ -1002,7 +1224,7 @@ class VM():
             # load some user specific overwriting config, if any. FIXME: index by VM config ID
             memsize_g=self._config.memsize_g
             nb_cpus=self._config.nb_cpus
-            home_dir=pwd.getpwuid(self._uid).pw_dir
+            home_dir=util.get_user_pwent(self._uid).pw_dir
             configpath="%s/.config/fairshell/virt-system/config.json"%home_dir
             if os.path.exists(configpath):
                 try:
@@ -1014,31 +1236,18 @@ class VM():
                     raise Exception("Error loading '%s' config file: %s"%(configpath, str(e)))
         
             # ensure CPU virt.extensions are loaded
-            (status, out, err)=util.exec_sync(["lsmod"])
-            if status!=0:
-                raise Exception("Can't run 'lsmod'")
-            if "kvm" not in out:
+            if not any(os.path.isdir(path) for path in _kvm_module_dirs):
                 raise Exception("CPU virtualization extensions are not activated\n(check the BIOS/UEFI settings)")
 
             # determine the number of CPUs to allocate to the VM (keep 1 for Linux)
-            hostcpus=0
-            data=util.load_file_contents("/proc/cpuinfo")
-            for line in data.splitlines():
-                if line.startswith("processor"):
-                    hostcpus+=1
+            hostcpus=os.cpu_count() or 0 # online CPUs
             if nb_cpus>=hostcpus:
                 nb_cpus=hostcpus-1
             if nb_cpus<1:
                 raise Exception("Not enough vCPU available to start Windows")
 
             # determine the quantity of RAM to allocate to the VM (keep 2 Gb for Linux)
-            host_memsize_g=0
-            data=util.load_file_contents("/proc/meminfo")
-            for line in data.splitlines():
-                if line.startswith("MemTotal"):
-                    parts=line.split()
-                    host_memsize_g=int(parts[1])/2**20
-
+            host_memsize_g=os.sysconf("SC_PAGE_SIZE")*os.sysconf("SC_PHYS_PAGES")/2**30 # same as /proc/meminfo's MemTotal
             if memsize_g>=host_memsize_g-2:
                 memsize_g=host_memsize_g-2
             if memsize_g<=1:
@@ -1077,11 +1286,9 @@ class VM():
             if cancel_requested_func and cancel_requested_func():
                 raise evh.Cancelled("Cancelled")
 
-            # wait a bit before allowing the viewer to be started
-            for i in range(1, 10):
-                if cancel_requested_func and cancel_requested_func():
-                    raise evh.Cancelled("Cancelled")
-                time.sleep(1)
+            # wait for the Spice server before allowing the viewer to be started
+            if password is not None:
+                self._wait_spice_server(cancel_requested_func)
 
             return password
         except evh.Cancelled as e:
@@ -1094,6 +1301,23 @@ class VM():
             self.stop()
             raise e
 
+    def _wait_spice_server(self, cancel_requested_func, timeout=9):
+        """Wait until the VM's Spice server accepts connections, for at most @timeout seconds"""
+        end=time.monotonic()+timeout
+        while time.monotonic()<end:
+            if cancel_requested_func and cancel_requested_func():
+                raise evh.Cancelled("Cancelled")
+            port=self.get_spice_listening_port()
+            if port and port>0:
+                try:
+                    with socket.create_connection((self._spice_listen, port), timeout=0.2):
+                        return
+                except OSError:
+                    pass
+            time.sleep(0.05)
+        # let the viewer try anyway
+        syslog.syslog(syslog.LOG_WARNING, "The VM's Spice server is not reachable after %s seconds"%timeout)
+
     def stop(self):
         """Destroy the VM."""
         try:
@@ -1164,46 +1388,43 @@ class VM():
             raise Exception("Could not define the VM: %s"%err)
 
         # start the VM
-        (status, out, err)=util.exec_sync(["virsh", "start", self._config.dom_name], C_locale=True)
-        if status!=0:
-            syslog.syslog(syslog.LOG_ERR, "Could not start VM: %s"%err)
-            raise Exception("Could not start VM: %s"%err)
+        try:
+            self._spice_port=None
+            self._spice_listen=None
+            _get_libvirt_conn().lookupByName(self._config.dom_name).create()
+            _domain_states.pop(self._config.dom_name, None)
+        except libvirt.libvirtError as e:
+            syslog.syslog(syslog.LOG_ERR, "Could not start VM: %s"%str(e))
+            raise Exception("Could not start VM: %s"%str(e))
 
         return password
 
     def _virt_vm_ensure_destroyed(self):
-        # destroy VM if it's running
-        (status, out, err)=util.exec_sync(["virsh", "list", "--all"], C_locale=True)
-        if status!=0:
-            syslog.syslog(syslog.LOG_ERR, "Could not list virt. VMs: %s"%err)
-            raise Exception("Could not list virt. VMs: %s"%err)
-
-        for line in out.splitlines():
-            parts=line.split()
-            if len(parts)>=3 and parts[1]==self._config.dom_name and (parts[2]=="running" or parts[2]=="paused"):
-                (status, out, err)=util.exec_sync(["virsh", "destroy", self._config.dom_name], C_locale=True)
-                if status!=0:
-                    syslog.syslog(syslog.LOG_ERR, "Could not destroy VM '%s': %s"%(self._config.dom_name, err))
-                    raise Exception("Could not destroy VM '%s': %s"%(self._config.dom_name, err))
-                break
-
-        self._virt_vm_ensure_undefined()
-
-    def _virt_vm_ensure_undefined(self):
-        # undefine VM if it's defined
-        (status, out, err)=util.exec_sync(["virsh", "list", "--all"], C_locale=True)
-        if status!=0:
-            syslog.syslog(syslog.LOG_ERR, "Could not list virt. VMs: %s"%err)
-            raise Exception("Could not list virt. VMs: %s"%err)
-
-        for line in out.splitlines():
-            parts=line.split()
-            if len(parts)>=3 and parts[1]==self._config.dom_name:
-                (status, out, err)=util.exec_sync(["virsh", "undefine", "--nvram", self._config.dom_name], C_locale=True)
-                if status!=0:
-                    syslog.syslog(syslog.LOG_ERR, "Could not undefine VM '%s': %s"%(self._config.dom_name, err))
-                    raise Exception("Could not undefine VM '%s': %s"%(self._config.dom_name, err))
-                break
+        # destroy VM if it's running (the libvirt call is avoided if it is known to be stopped)
+        try:
+            dom=_lookup_domain(self._config.dom_name)
+            if dom is None:
+                return # not even defined
+            if _domain_states.get(self._config.dom_name)!=State.STOPPED and dom.isActive():
+                dom.destroy()
+                _domain_states.pop(self._config.dom_name, None)
+        except libvirt.libvirtError as e:
+            syslog.syslog(syslog.LOG_ERR, "Could not destroy VM '%s': %s"%(self._config.dom_name, str(e)))
+            raise Exception("Could not destroy VM '%s': %s"%(self._config.dom_name, str(e)))
+
+        self._virt_vm_ensure_undefined(dom)
+
+    def _virt_vm_ensure_undefined(self, dom=None):
+        # undefine VM if it's defined, @dom is the VM's domain if it has just been looked up
+        try:
+            if dom is None:
+                dom=_lookup_domain(self._config.dom_name)
+            if dom:
+                dom.undefineFlags(libvirt.VIR_DOMAIN_UNDEFINE_NVRAM)
+                _domain_states.pop(self._config.dom_name, None)
+        except libvirt.libvirtError as e:
+            syslog.syslog(syslog.LOG_ERR, "Could not undefine VM '%s': %s"%(self._config.dom_name, str(e)))
+            raise Exception("Could not undefine VM '%s': %s"%(self._config.dom_name, str(e)))
 
 
     
\ No newline at end of file
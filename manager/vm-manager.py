@@ -29,7 +29,6 @@ import syslog
 import json
 import datetime
 import signal
-import pyinotify
 import netaddr
 from gi.repository import GLib
 
@@ -73,7 +72,7 @@ class DNSWatcher(evh.InotifyComponent):
             # NetworkManager may not have the /org/freedesktop/NetworkManager/DnsManager object
             self._nm=None
             syslog.syslog(syslog.LOG_INFO, "Using /etc/resolv.conf as DNS source")
-            self.watch("/etc/resolv.conf", pyinotify.IN_MOVED_TO | pyinotify.IN_CLOSE_WRITE)
+            self.watch("/etc/resolv.conf", evh.IN_MOVED_TO | evh.IN_CLOSE_WRITE)
 
         # generate initial version of the file
         self._ns_list=["1.1.1.1", "8.8.8.8", "9.9.9.9"]
@@ -122,7 +121,7 @@ class DNSWatcher(evh.InotifyComponent):
 class AllowedIPs:
     """This object allows IPs via the Linux's netfilter chain specified at creation, and removes that
     authorization once the TTL has been reached"""
-    def __init__(self, allow_table_name, allow_chain_name):
+    def __init__(self, allow_table_name, allow_chain_name, allow_set_name):
         self._chain=None
         self._by_ttl={} # key: unix TS corresponding to the TTLs, value= IPs list expiring @ the TTL
         self._by_ips={}  # key: ip address, value= unix TS of the TTL for that IP address
@@ -130,8 +129,7 @@ class AllowedIPs:
         # define netfilter chain
         if VM.system_is_nftables:
             self._table=nft.Table(allow_table_name) # should already be present
-            self._chain=nft.Chain(self._table, allow_chain_name, None, None) # should already be present
-            self._rules={} # key=IP address, value= associated nft.Rule (needed to be able to uninstall rules)
+            self._set=nft.Set(self._table, allow_set_name, "ipv4_addr") # should already be present
         else:
             self._chain=nip.Chain("filter", allow_chain_name)
             self._chain.install()
@@ -177,9 +175,7 @@ class AllowedIPs:
         # actually allow IP address
         syslog.syslog(syslog.LOG_INFO, "ALLOWING IP address %s (TTL %s)"%(ip, ttl))
         if VM.system_is_nftables:
-            rule=nft.Rule(self._chain, ["ip", "daddr", "%s/32"%ip, "accept"])
-            rule.add()
-            self._rules[ip]=rule
+            self._set.add_elements([ip])
         else:
             rule=nip.Rule("filter", ["-I", self._chain.name, "-d", "%s/32"%ip, "-j", "ACCEPT"])
             rule.install()
@@ -209,12 +205,10 @@ class AllowedIPs:
             syslog.syslog(syslog.LOG_INFO, "Denying access to %s (expired)"%ip)
             del self._by_ips[ip]
             if VM.system_is_nftables:
-                rule=self._rules[ip]
                 try:
-                    rule.delete()
+                    self._set.delete_elements([ip])
                 except:
                     pass
-                del self._rules[ip]
             else:
                 rule=nip.Rule("filter", ["-I", self._chain.name, "-d", "%s/32"%ip, "-j", "ACCEPT"])
                 rule.uninstall()
@@ -233,12 +227,12 @@ class ResolvedIpWatcher(evh.InotifyComponent):
     Each resolved IP is in a JSON file in the @dirname directory, with a contents like:
     [{'TTL': 86252, 'A': '209.82.215.200', 'AAAA': None}]
     """
-    def __init__(self, allow_table_name, allow_chain_name, dirname):
+    def __init__(self, allow_table_name, allow_chain_name, allow_set_name, dirname):
         evh.InotifyComponent.__init__(self)
-        self._ips=AllowedIPs(allow_table_name, allow_chain_name)
+        self._ips=AllowedIPs(allow_table_name, allow_chain_name, allow_set_name)
         os.makedirs(dirname, exist_ok=True)
         os.chmod(dirname, 0o777)
-        self.watch(dirname, pyinotify.IN_MOVED_TO | pyinotify.IN_CLOSE_WRITE)
+        self.watch(dirname, evh.IN_MOVED_TO | evh.IN_CLOSE_WRITE)
 
         # NB: the existing authorised IPs are ignored as we don't know their associated TTL
         #     and as te risk of being a security risk is low. We can't remove them because
@@ -423,7 +417,7 @@ class Manager(evh.DBusServer):
                 res[id]=[config.descr]
         return res
 
-    @dbus.service.method("org.fairshell.VMManager", sender_keyword="sender", connection_keyword="bus", in_signature="s", out_signature="s")
+    @dbus.service.method("org.fairshell.VMManager", sender_keyword="sender", connection_keyword="bus", in_signature="s", out_signature="a{sv}")
     def get_configuration(self, id, sender=None, bus=None):
         """List the configurations available to the caller"""
         (uid, gid)=self.get_user_ident(sender, bus)
@@ -436,7 +430,7 @@ class Manager(evh.DBusServer):
                     "image-file": config.base_image_file,
                     "writable": config.writable
                 }
-                return json.dumps(data)
+                return data
         raise Exception("No configuration '%s' available"%id)
 
     def _get_vmo(self, id, uid, gid):
@@ -536,17 +530,19 @@ class Manager(evh.DBusServer):
             _vmo.start_job_id=None
             password=self.job_get_result(job_id)
             syslog.syslog(syslog.LOG_INFO, "VM '%s' started for %s.%s"%(vmo.id, vmo.uid, vmo.gid))
-            conf=""
             if vmo.display_mode!=VM.DisplayMode.NONE:
                 spice_port=vmo.get_spice_listening_port()
+                if spice_port is None or spice_port<=0:
+                    # can't be sent in the a{sv} dictionary
+                    raise Exception("The VM's Spice server has no listening port")
                 conf={
                     "port": spice_port,
                     "password": password,
                     "fullscreen": True if vmo.display_mode==VM.DisplayMode.FULLSCREEN else False,
-                    "usb-redir": vmo.usb_redir,
+                    "usb-redir": dbus.Array(vmo.usb_redir, signature="s"), # may be empty
                     "title": vmo.descr
                 }
-                vmo.ui_config=json.dumps(conf)
+                vmo.ui_config=conf
             self.started(vmo.id, vmo.uid, vmo.gid)
         except evh.Cancelled as e:
             syslog.syslog(syslog.LOG_INFO, "VM '%s' start cancelled: %s"%(id, str(e)))
@@ -572,7 +568,7 @@ class Manager(evh.DBusServer):
         vmo=ManagedVM(id, self._confs[id], uid, gid)
         vmo.auto_undefine=False
         self._vms[id]+=[vmo]
-        rip=ResolvedIpWatcher(vmo.allow_table_name, vmo.allow_chain_name, vmo.resolv_notif_dir)
+        rip=ResolvedIpWatcher(vmo.allow_table_name, vmo.allow_chain_name, vmo.allow_set_name, vmo.resolv_notif_dir)
         self._hub.register(rip)
         vmo.rip=rip
         syslog.syslog(syslog.LOG_INFO, "START requested for VM '%s'"%id)
@@ -583,7 +579,7 @@ class Manager(evh.DBusServer):
         vmo.start_job_id=self.job_run(self._start_job, args, self._start_done_callback)
         syslog.syslog(syslog.LOG_INFO, "start job ID for VM '%s', user %s.%s: %s"%(id, uid, gid, vmo.start_job_id))
 
-    @dbus.service.method("org.fairshell.VMManager", sender_keyword="sender", connection_keyword="bus", in_signature="s")
+    @dbus.service.method("org.fairshell.VMManager", sender_keyword="sender", connection_keyword="bus", in_signature="s", out_signature="a{sv}")
     def get_ui_access(self, id, sender=None, bus=None):
         """Get the settings required to connect to the UI of a VM"""
         (uid, gid)=self.get_user_ident(sender, bus)
@@ -862,6 +858,7 @@ try:
         raise Exception("This programm must be run as root")
 
     hub=evh.Hub()
+    VM.init_libvirt_events()
     manager=Manager(hub)
     hub.register(manager)
 
@@ -170,7 +170,6 @@ def _common_vm_run(proxy, conf_id):
         raise Exception("VM with Id '%s' is already running"%conf_id)
 
     vm_conf=proxy.get_configuration(conf_id)
-    vm_conf=json.loads(vm_conf)
     writable=vm_conf["writable"]
 
     # run the VM and the viewer, and
@@ -253,9 +252,7 @@ def _do_install(args, proxy):
 try:
     # DBus connection
     dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
-    bus=dbus.SystemBus()
-    obj=bus.get_object("org.fairshell.VMManager", "/remote/virtualmachines")
-    proxy=dbus.Interface(obj, dbus_interface="org.fairshell.VMManager")
+    proxy=util.get_vmmanager_proxy()
 
     if args.cmde is None:
         print("%s"%parser.format_help())